@@ -0,0 +1,99 @@
+"""
+Measures the segment concatenation loop of the assembler.
+
+Generates a segment directory with the layout the downloader leaves behind
+(a .m4v and a .m4a file per segment) and builds the two track files from it
+three times: the way assemble() used to, reopening the track file in append
+mode and copying through user space for every segment, with
+fastcopy.append_file, which keeps the track files open and copies inside
+the kernel, and with both tracks built side by side the way assemble() does
+now. The page cache is warm for all of them, so the numbers show the cost
+of the loop rather than of the disk.
+
+    python benchmarks/assemble_concat.py [--segments 10000] [--video-kb 60] [--audio-kb 8] [--dir DIR]
+"""
+import argparse
+import concurrent.futures
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyinstalive import assembler  # noqa: E402
+from pyinstalive import fastcopy  # noqa: E402
+
+
+def generate(directory, segments, video_size, audio_size):
+    video_data = os.urandom(video_size)
+    audio_data = os.urandom(audio_size)
+    pairs = []
+    for n in range(segments):
+        video = os.path.join(directory, '17905387649602356_0-{0:d}.m4v'.format(n * 2000))
+        with open(video, 'wb') as f:
+            f.write(video_data)
+        with open(video.replace('.m4v', '.m4a'), 'wb') as f:
+            f.write(audio_data)
+        pairs.append((video, video.replace('.m4v', '.m4a')))
+    return pairs
+
+
+def concat_legacy(pairs, video_stream, audio_stream):
+    for video_segment, audio_segment in pairs:
+        with open(video_stream, 'ab') as outfile, open(video_segment, 'rb') as readfile:
+            shutil.copyfileobj(readfile, outfile)
+        with open(audio_stream, 'ab') as outfile, open(audio_segment, 'rb') as readfile:
+            shutil.copyfileobj(readfile, outfile)
+
+
+def concat_kernel(pairs, video_stream, audio_stream):
+    with open(video_stream, 'wb', buffering=0) as video_file, open(audio_stream, 'wb', buffering=0) as audio_file:
+        for video_segment, audio_segment in pairs:
+            fastcopy.append_file(video_file, video_segment)
+            fastcopy.append_file(audio_file, audio_segment)
+
+
+def concat_parallel(pairs, video_stream, audio_stream):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        tracks = [executor.submit(assembler._build_track, video_stream, [pair[0] for pair in pairs]),
+                  executor.submit(assembler._build_track, audio_stream, [pair[1] for pair in pairs])]
+        for track in tracks:
+            track.result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--segments', type=int, default=10000)
+    parser.add_argument('--video-kb', type=int, default=60)
+    parser.add_argument('--audio-kb', type=int, default=8)
+    parser.add_argument('--dir', help='where to generate the segments, a temporary directory if not given')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='pyinstalive-bench-', dir=args.dir)
+    try:
+        pairs = generate(directory, args.segments, args.video_kb * 1024, args.audio_kb * 1024)
+        total = args.segments * (args.video_kb + args.audio_kb) / 1024.0
+        print('{0:d} segments, {1:.0f} MB, kernel copy methods: {2!s}'.format(
+            args.segments, total, ', '.join(m.__name__.strip('_') for m in fastcopy.METHODS) or 'none'))
+        print('{0:<10s} {1:>9s} {2:>9s}'.format('method', 'seconds', 'MB/s'))
+        results = {}
+        for name, concat in (('legacy', concat_legacy), ('kernel', concat_kernel), ('parallel', concat_parallel)):
+            video_stream = os.path.join(directory, 'video_{0!s}.tmp'.format(name))
+            audio_stream = os.path.join(directory, 'audio_{0!s}.tmp'.format(name))
+            started = time.time()
+            concat(pairs, video_stream, audio_stream)
+            elapsed = time.time() - started
+            results[name] = (os.path.getsize(video_stream), os.path.getsize(audio_stream))
+            print('{0:<10s} {1:>9.2f} {2:>9.0f}'.format(name, elapsed, total / elapsed))
+            os.remove(video_stream)
+            os.remove(audio_stream)
+        if len(set(results.values())) != 1:
+            sys.exit('The track files differ in size: {0!s}'.format(results))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
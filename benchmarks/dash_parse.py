@@ -0,0 +1,125 @@
+"""
+Measures the per-poll cost of parsing IG live mpds.
+
+Compares the fast tokenizer in pyinstalive.dash with the ElementTree fallback
+and with the plain ElementTree + namespaced findall walk the downloader used
+before. Captured mpds can be given as arguments; without arguments mpds with
+the layout IG sends (two video and one audio representation) are generated
+for a range of timeline window sizes.
+
+    python benchmarks/dash_parse.py [captured.mpd ...]
+"""
+import os
+import sys
+import timeit
+import xml.etree.ElementTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyinstalive import dash  # noqa: E402
+
+WINDOW_SIZES = [5, 30, 150, 600]
+
+_MPD = (
+    '<?xml version="1.0"?>\n'
+    '<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="dynamic" minimumUpdatePeriod="PT1S" '
+    'timeShiftBufferDepth="PT{depth}S" availabilityStartTime="2022-06-10T15:02:02Z">'
+    '<Period id="0" start="PT0S">'
+    '<AdaptationSet id="0" mimeType="video/mp4" segmentAlignment="true">'
+    '<Representation id="17905387649602356v" mimeType="video/mp4" codecs="avc1.4d401f" width="720" '
+    'height="1280" bandwidth="1200000" FBQualityLabel="720p">'
+    '<SegmentTemplate initialization="../17905387649602356_0-init.m4v" '
+    'media="../17905387649602356_0-$Time$.m4v" timescale="1000">'
+    '<SegmentTimeline>{timeline}</SegmentTimeline></SegmentTemplate></Representation>'
+    '<Representation id="17905387649602356l" mimeType="video/mp4" codecs="avc1.4d401f" width="360" '
+    'height="640" bandwidth="400000" FBQualityLabel="360p">'
+    '<SegmentTemplate initialization="../17905387649602356l_0-init.m4v" '
+    'media="../17905387649602356l_0-$Time$.m4v" timescale="1000">'
+    '<SegmentTimeline>{timeline}</SegmentTimeline></SegmentTemplate></Representation>'
+    '</AdaptationSet>'
+    '<AdaptationSet id="1" mimeType="audio/mp4">'
+    '<Representation id="17905387649602356a" mimeType="audio/mp4" codecs="mp4a.40.2" '
+    'audioSamplingRate="44100" bandwidth="64000">'
+    '<AudioChannelConfiguration schemeIdUri="urn:mpeg:dash:23003:3:audio_channel_configuration:2011" value="2"/>'
+    '<SegmentTemplate initialization="../17905387649602356_0-init.m4a" '
+    'media="../17905387649602356_0-$Time$.m4a" timescale="1000">'
+    '<SegmentTimeline>{timeline}</SegmentTimeline></SegmentTemplate></Representation>'
+    '</AdaptationSet></Period></MPD>')
+
+
+def generate_mpd(window):
+    timeline = ''.join('<S t="{0:d}" d="2000"/>'.format(1654873322000 + i * 2000) for i in range(window))
+    return _MPD.format(depth=window * 2, timeline=timeline).encode('utf-8')
+
+
+def parse_elementtree_walk(content):
+    """The ElementTree walk _download_mpd/_process_mpd did on every poll"""
+    mpd = xml.etree.ElementTree.fromstring(content)
+    entries = 0
+    for period in mpd.findall('mpd:Period', dash.MPD_NAMESPACE):
+        for adaptation_set in period.findall('mpd:AdaptationSet', dash.MPD_NAMESPACE):
+            for representation in adaptation_set.findall('mpd:Representation', dash.MPD_NAMESPACE):
+                segment_template = representation.find('mpd:SegmentTemplate', dash.MPD_NAMESPACE)
+                segment_timeline = segment_template.find('mpd:SegmentTimeline', dash.MPD_NAMESPACE)
+                entries += len(segment_timeline.findall('mpd:S', dash.MPD_NAMESPACE))
+    return entries
+
+
+def _representations(manifest):
+    for period in manifest.periods:
+        for adaptation_set in period.adaptation_sets:
+            for representation in adaptation_set.representations:
+                yield representation
+
+
+def poll_fast(content):
+    """A steady state poll: parse, then pick up the newest entry of each timeline"""
+    entries = 0
+    for representation in _representations(dash.parse_fast(content)):
+        segments = representation.template.segments
+        entries += len(segments.since(LAST_SEEN.get(representation.id)))
+    return entries
+
+
+def decode_fast(content):
+    """The fast parser with every timeline decoded, as on the first poll"""
+    return sum(len(list(representation.template.segments))
+               for representation in _representations(dash.parse_fast(content)))
+
+
+LAST_SEEN = {}
+
+
+def bench(label, content):
+    # everything but the newest entry has been seen before
+    LAST_SEEN.clear()
+    for representation in _representations(dash.parse_etree(content)):
+        segments = representation.template.segments
+        LAST_SEEN[representation.id] = segments[-2][0] if len(segments) > 1 else None
+
+    number = max(10, 20000 // max(1, content.count(b'<S ')))
+    print('{0:<28s} {1:>8d} bytes'.format(label, len(content)))
+    results = {}
+    for name, func in [('elementtree walk', parse_elementtree_walk),
+                       ('dash.parse_etree', dash.parse_etree),
+                       ('dash.parse_fast (decoded)', decode_fast),
+                       ('dash.parse_fast + since', poll_fast)]:
+        best = min(timeit.repeat(lambda: func(content), number=number, repeat=5)) / number
+        results[name] = best
+        print('    {0:<28s} {1:>10.1f} us/poll'.format(name, best * 1e6))
+    print('    {0:<28s} {1:>10.2f}x'.format(
+        'speedup vs walk', results['elementtree walk'] / results['dash.parse_fast + since']))
+
+
+def main(paths):
+    if paths:
+        for path in paths:
+            with open(path, 'rb') as f:
+                bench(os.path.basename(path), f.read())
+    else:
+        for window in WINDOW_SIZES:
+            bench('window={0:d}'.format(window), generate_mpd(window))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,202 @@
+"""
+Compares the requests (HTTP/1.1) and http2 transports on a local server.
+
+Each round fetches an mpd and a burst of segments concurrently, the way
+the downloader does after a poll. The servers add a fixed delay per
+request to stand in for CDN latency and count the connections clients
+open. The HTTP/2 server speaks h2c with prior knowledge, so no TLS is
+involved and the difference in connections opened is the part that
+carries over to a real CDN, where each one also costs a TLS handshake.
+
+    python benchmarks/http_transport.py [--rounds 30] [--workers 8] [--delay 0.02]
+"""
+import argparse
+import concurrent.futures
+import os
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import requests  # noqa: E402
+
+from pyinstalive import transport  # noqa: E402
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+except ImportError:
+    h2 = None
+
+SEGMENT_SIZE = 48 * 1024
+MPD_SIZE = 4 * 1024
+
+
+def _body(path):
+    return b'\0' * (MPD_SIZE if path.endswith('.mpd') else SEGMENT_SIZE)
+
+
+class Http1Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.connections = 0
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), Http1Handler)
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        ThreadingHTTPServer.process_request(self, request, client_address)
+
+
+class Http1Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        body = _body(self.path)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class H2cServer(object):
+    """Minimal HTTP/2 server without TLS, answering every stream from its own thread"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.connections = 0
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(64)
+        self.server_address = self.sock.getsockname()
+
+    def serve_forever(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            thread = threading.Thread(target=self._serve, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def shutdown(self):
+        self.sock.close()
+
+    def _serve(self, client):
+        conn = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False))
+        cond = threading.Condition()
+        conn.initiate_connection()
+        client.sendall(conn.data_to_send())
+        while True:
+            try:
+                data = client.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            with cond:
+                events = conn.receive_data(data)
+                for event in events:
+                    if isinstance(event, h2.events.RequestReceived):
+                        path = dict(event.headers).get(b':path', b'').decode()
+                        thread = threading.Thread(
+                            target=self._respond, args=(client, conn, cond, event.stream_id, path))
+                        thread.daemon = True
+                        thread.start()
+                cond.notify_all()
+                outgoing = conn.data_to_send()
+                if outgoing:
+                    client.sendall(outgoing)
+
+    def _respond(self, client, conn, cond, stream_id, path):
+        time.sleep(self.delay)
+        body = _body(path)
+        with cond:
+            conn.send_headers(stream_id, [(':status', '200'), ('content-length', str(len(body)))])
+            while body:
+                # wait for the client to open the flow control window
+                while conn.local_flow_control_window(stream_id) <= 0:
+                    client.sendall(conn.data_to_send())
+                    cond.wait()
+                size = min(conn.local_flow_control_window(stream_id), conn.max_outbound_frame_size, len(body))
+                conn.send_data(stream_id, body[:size], end_stream=size == len(body))
+                body = body[size:]
+            client.sendall(conn.data_to_send())
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def run(http, base_url, rounds, workers):
+    latencies = []
+
+    def fetch(url):
+        started = time.time()
+        with http.get(url, timeout=10, stream=True) as res:
+            res.raise_for_status()
+            buf = memoryview(bytearray(64 * 1024))
+            while res.raw.readinto(buf):
+                pass
+        latencies.append(time.time() - started)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for n in range(rounds):
+            fetch(base_url + '/live.mpd')
+            urls = ['{0!s}/{1:d}_{2:d}.m4v'.format(base_url, n, i) for i in range(workers)]
+            list(executor.map(fetch, urls))
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=30)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--delay', type=float, default=0.02, help='server side delay per request in seconds')
+    args = parser.parse_args()
+
+    if not transport.http2_available() or h2 is None:
+        sys.exit('This benchmark needs the httpx and h2 packages.')
+
+    print('{0:<10s} {1:>12s} {2:>9s} {3:>9s} {4:>9s} {5:>9s}'.format(
+        'transport', 'connections', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for name in transport.TRANSPORTS:
+        server = Http1Server(args.delay) if name == 'requests' else H2cServer(args.delay)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.workers + 2)
+        session.mount('http://', adapter)
+        if name == 'http2':
+            http = transport.Http2Transport(session, prior_knowledge=True)
+        else:
+            http = transport.RequestsTransport(session)
+        base_url = 'http://{0!s}:{1:d}'.format(*server.server_address)
+        try:
+            latencies = run(http, base_url, args.rounds, args.workers)
+        finally:
+            http.close()
+            server.shutdown()
+        print('{0:<10s} {1:>12d} {2:>9.1f} {3:>9.1f} {4:>9.1f} {5:>9.1f}'.format(
+            name, server.connections,
+            _percentile(latencies, 50) * 1000, _percentile(latencies, 95) * 1000,
+            _percentile(latencies, 99) * 1000, max(latencies) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,12 +3,15 @@ import json
 
 from . import helpers
 from . import globals
+from . import metrics
 from .constants import Constants
 
+@metrics.timed
 def get_csrf_token():
-    response = globals.session.session.get(Constants.LOGIN_PAGE)
+    response = globals.session.get_transport().get(Constants.LOGIN_PAGE)
     return helpers.get_shared_data(response.text).get("csrf_token", None)
 
+@metrics.timed
 def do_login():
     now_epoch = int(datetime.now().timestamp())
     login_data = {
@@ -17,35 +20,42 @@ def do_login():
     "queryParams": {},
     "optIntoOneTap": "false"
     }
-    response = globals.session.session.post(Constants.LOGIN_AJAX, data=login_data, timeout=5)
+    response = globals.session.get_transport().post(Constants.LOGIN_AJAX, data=login_data, timeout=5)
     return json.loads(response.text)
 
+@metrics.timed
 def get_login_state():
-    response = globals.session.session.get(Constants.BASE_WEB, timeout=5)
+    response = globals.session.get_transport().get(Constants.BASE_WEB, timeout=5)
     return helpers.get_shared_data(response.text)
 
+@metrics.timed
 def get_user_info():
-    response = globals.session.session.get(Constants.USER_INFO.format(globals.download.download_user), timeout=5)
+    response = globals.session.get_transport().get(Constants.USER_INFO.format(globals.download.download_user), timeout=5)
     if response.status_code == 429:
         raise Exception("RATE_LIMITED")
     return json.loads(response.text) if response.status_code == 200 else {}
 
+@metrics.timed
 def get_reels_tray():
-    response = globals.session.session.get(Constants.REELS_TRAY, timeout=5)
+    response = globals.session.get_transport().get(Constants.REELS_TRAY, timeout=5)
     return json.loads(response.text)
 
+@metrics.timed
 def get_single_live():
-    response = globals.session.session.get(Constants.LIVE_STATE_USER.format(globals.download.download_user_id), timeout=5)
+    response = globals.session.get_transport().get(Constants.LIVE_STATE_USER.format(globals.download.download_user_id), timeout=5)
     return json.loads(response.text)
 
+@metrics.timed
 def get_comments():
-    response = globals.session.session.get(Constants.LIVE_COMMENT.format(globals.download.livestream_object_init.get('id'), str(globals.comments.comments_last_ts)), timeout=5)
+    response = globals.session.get_transport().get(Constants.LIVE_COMMENT.format(globals.download.livestream_object_init.get('id'), str(globals.comments.comments_last_ts)), timeout=5)
     return json.loads(response.text)
 
+@metrics.timed
 def get_stream_data():
-    response = globals.session.session.get(Constants.LIVE_STATE_USER.format(globals.download.download_user_id), timeout=5)
+    response = globals.session.get_transport().get(Constants.LIVE_STATE_USER.format(globals.download.download_user_id), timeout=5)
     return json.loads(response.text)
 
+@metrics.timed
 def do_heartbeat():
-    response = globals.session.session.post(Constants.LIVE_HEARTBEAT.format(globals.download.livestream_object_init.get('id')), timeout=5)
+    response = globals.session.get_transport().post(Constants.LIVE_HEARTBEAT.format(globals.download.livestream_object_init.get('id')), timeout=5)
     return json.loads(response.text)
\ No newline at end of file
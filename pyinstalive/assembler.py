@@ -1,13 +1,22 @@
+import glob
 import os
-import shutil
 import re
-import glob
+import struct
 import subprocess
 import json
+import concurrent.futures
+import heapq
+import queue
+import threading
+import time
+import zlib
 
 from . import globals
 from . import logger
 from . import helpers
+from . import fastcopy
+from . import manifest
+from . import remux
 from .download import Download
 """
 The content of this file was originally written by https://github.com/taengstagram
@@ -23,137 +32,637 @@ def _get_file_index(filename):
     return -1
 
 
-def assemble(retry_with_zero_m4v=False):
-    try:
-        logger.binfo('Assembling segments into video file.')
-        logger.separator()
-        livestream_info = {}
-        if globals.args.generate_video_path:
-            globals.download = Download()
-            globals.download.segments_path = globals.args.generate_video_path if not globals.args.generate_video_path.endswith(".json") else globals.args.generate_video_path.replace(".json", "")
-            globals.download.data_json_path = globals.args.generate_video_path if globals.args.generate_video_path.endswith(".json") else globals.args.generate_video_path + ".json"
-            globals.download.video_path = globals.download.segments_path + ".mp4"
-
-        if not os.path.isdir(globals.download.segments_path):
-            logger.error("Could not assemble segments: The segment directory does not exist.")
-            return
-        elif not os.listdir(globals.download.segments_path):
-            logger.error("Could not assemble segments: The segment directory does not contain any files.")
+REPAIR_INIT = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'repair', 'init.m4v')
+AUDIO_STREAM_FORMAT = 'assembled_source_{0}_{1}_mp4.tmp'
+VIDEO_STREAM_FORMAT = 'assembled_source_{0}_{1}_m4a.tmp'
+MANIFEST_FORMAT = 'assembled_source_{0}_manifest.json'
+MANIFEST_VERSION = 1
+# parts of a recording cut while downloading, next to the segments folder
+PART_FORMAT = '{0}_part{1:03d}.mp4'
+# the init segment of a track, kept for the parts written after a resume
+INIT_FORMAT = 'assembled_source_{0}_{1}_init.tmp'
+# the checksum of a range covers its last bytes, the seam to the next segment
+CHECKSUM_BYTES = 4096
+MAX_ATTEMPTS = 3
+# returned by _assemble() to assemble again with the *-0.m4v segment
+RETRY_WITH_ZERO_M4V = 'retry_with_zero_m4v'
+
+
+def _resolve_segment(segment, files=None):
+    """
+    Returns what to do with a video segment: ('missing', (video file, audio file)),
+    ('skipped', (video file, audio file)) or ('append', (video file, audio file)).
+    The *-0.m4v segment is skipped, it is never part of the track files.
+
+    :param files: names in the segment directory, looked up instead of the file system
+    """
+    segment = segment.split('?', 1)[0]
+    pair = (segment, segment.replace('.m4v', '.m4a'))
+    if files is None:
+        exists = os.path.isfile(pair[0]) and os.path.isfile(pair[1])
+    else:
+        exists = os.path.basename(pair[0]) in files and os.path.basename(pair[1]) in files
+    if not exists:
+        return 'missing', pair
+    if segment.endswith('-init.m4v'):
+        segment = REPAIR_INIT
+    if segment.endswith('-0.m4v'):
+        return 'skipped', pair
+    return 'append', (segment, segment.replace('.m4v', '.m4a'))
+
+
+def _checksum(readfile, offset, size):
+    """crc32 of the last CHECKSUM_BYTES of the range"""
+    tail = min(size, CHECKSUM_BYTES)
+    readfile.seek(offset + size - tail)
+    return zlib.crc32(readfile.read(tail))
+
+
+class AssemblyManifest(object):
+    """
+    Records which segments were concatenated into the track files. Every
+    track has one [name, offset, size, mtime_ns, crc32] range per segment.
+    A later assembly keeps the longest prefix of ranges that still matches
+    both the segment files and the track file and only appends the rest.
+    """
+    TRACKS = ('video', 'audio')
+
+    def __init__(self, segments_path, stream_id):
+        self.path = os.path.join(segments_path, MANIFEST_FORMAT.format(stream_id))
+        self.stream_id = str(stream_id)
+        self.ranges = dict((track, []) for track in self.TRACKS)
+
+    @classmethod
+    def load(cls, segments_path, stream_id):
+        """The manifest of an earlier assembly, an empty one if there is none or it is unusable"""
+        loaded = cls(segments_path, stream_id)
+        try:
+            with open(loaded.path) as manifest_file:
+                data = json.load(manifest_file)
+            if data.get('version') == MANIFEST_VERSION and data.get('stream_id') == loaded.stream_id:
+                loaded.ranges = dict((track, [list(r) for r in data['ranges'][track]]) for track in cls.TRACKS)
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+        return loaded
+
+    def save(self):
+        temp_path = self.path + '.part'
+        with open(temp_path, 'w') as manifest_file:
+            json.dump({'version': MANIFEST_VERSION, 'stream_id': self.stream_id, 'ranges': self.ranges},
+                      manifest_file)
+        os.replace(temp_path, self.path)
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def reusable(self, track, track_path, sources):
+        """
+        Returns how many of sources the track file already holds in this
+        order. The ranges after those are dropped.
+        """
+        ranges = self.ranges[track]
+        count = 0
+        try:
+            with open(track_path, 'rb') as trackfile:
+                track_size = os.fstat(trackfile.fileno()).st_size
+                end = 0
+                for source, (name, offset, size, mtime_ns, crc) in zip(sources, ranges):
+                    if name != os.path.basename(source) or offset != end or offset + size > track_size:
+                        break
+                    stat = os.stat(source)
+                    if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                        break
+                    if _checksum(trackfile, offset, size) != crc:
+                        break
+                    end = offset + size
+                    count += 1
+        except (IOError, OSError):
+            count = 0
+        del ranges[count:]
+        return count
+
+    def end(self, track):
+        """Where the next range of the track starts"""
+        ranges = self.ranges[track]
+        return ranges[-1][1] + ranges[-1][2] if ranges else 0
+
+
+def _append_segment(outfile, source, ranges):
+    """Appends source to outfile and records its range"""
+    with open(source, 'rb', buffering=0) as readfile:
+        stat = os.fstat(readfile.fileno())
+        offset = outfile.tell()
+        size = fastcopy.copy_range(readfile, outfile, 0, stat.st_size)
+        ranges.append([os.path.basename(source), offset, size, stat.st_mtime_ns, _checksum(readfile, 0, size)])
+    return size
+
+
+def _init_prefix(path):
+    """The ftyp and moov boxes a segment starts with, None if it does not carry the init segment"""
+    with open(path, 'rb') as readfile:
+        offset = 0
+        has_moov = False
+        while True:
+            header = readfile.read(8)
+            if len(header) < 8:
+                return None
+            size, box_type = struct.unpack('>I4s', header)
+            if box_type not in (b'ftyp', b'moov') or size < 8:
+                break
+            has_moov = has_moov or box_type == b'moov'
+            offset += size
+            readfile.seek(offset)
+        if not has_moov:
+            return None
+        readfile.seek(0)
+        return readfile.read(offset)
+
+
+def _write_init(segments_path, stream_id, track, init):
+    path = os.path.join(segments_path, INIT_FORMAT.format(stream_id, track))
+    with open(path, 'wb') as init_file:
+        init_file.write(init)
+    return path
+
+
+def _save_inits(segments_path, stream_id, pair):
+    """
+    Writes the init segments a (video, audio) segment pair starts with to
+    their INIT_FORMAT files. Returns the paths, None if the pair does not
+    carry them.
+    """
+    inits = [_init_prefix(source) for source in pair]
+    if None in inits:
+        return None
+    return tuple(_write_init(segments_path, stream_id, track, init)
+                 for track, init in zip(AssemblyManifest.TRACKS, inits))
+
+
+class IncrementalAssembler(object):
+    """
+    Appends the segments to the track temp files while the stream is being
+    downloaded, so only the mux is left once it ended.
+
+    The downloader reports every segment it requests and every segment that
+    completed or was given up on. A video segment is appended once it and its
+    audio segment are done and every video segment requested before it has
+    been appended, so segments completing out of order are held back. The
+    files are written from a thread of its own. finish() saves the manifest,
+    assemble() keeps the part of the track files that matches what it would
+    have concatenated itself.
+
+    With part_seconds or part_bytes the recording is cut into parts instead:
+    once a part has been recording for part_seconds or its track files reach
+    part_bytes, they are muxed into PART_FORMAT by a background thread and
+    the segments of the part are deleted. Every part starts with the init
+    segments, also the ones taken from the skipped *-0.m4v segment, so each
+    one plays on its own. A segment completing after a later one was written
+    is left out of the parts and kept on disk, assemble() picks it up with
+    the segments of the parts that could not be saved.
+    """
+
+    def __init__(self, segments_path, stream_id, part_seconds=0, part_bytes=0):
+        self.segments_path = segments_path
+        self.stream_id = stream_id
+        self.part_seconds = part_seconds
+        self.part_bytes = part_bytes
+        self.rolling = bool(part_seconds or part_bytes)
+        # parts of an interrupted run are kept, the numbering continues after them
+        self.part = len(glob.glob(glob.escape(segments_path) + '_part[0-9][0-9][0-9].mp4')) + 1 if self.rolling else 0
+        # segment names handled for the current part, deleted once it is saved
+        self.part_names = []
+        self.part_started = None
+        # the init segment of each track, written to the start of every part
+        self.inits = {}
+        for track in AssemblyManifest.TRACKS if self.rolling else ():
+            try:
+                with open(os.path.join(segments_path, INIT_FORMAT.format(stream_id, track)), 'rb') as f:
+                    self.inits[track] = f.read()
+            except (IOError, OSError):
+                pass
+        self.muxer = concurrent.futures.ThreadPoolExecutor(max_workers=1) if self.rolling else None
+        # futures of the muxed parts, resolving to the part file or None if it could not be saved
+        self.parts = []
+        # segments left out of the parts, assemble() picks them up with the ones of parts that failed
+        self.late = []
+        self.video_stream = os.path.join(segments_path, VIDEO_STREAM_FORMAT.format(stream_id, self.part))
+        self.audio_stream = os.path.join(segments_path, AUDIO_STREAM_FORMAT.format(stream_id, self.part))
+        self.manifest = AssemblyManifest(segments_path, stream_id)
+        # (video file, audio file) pairs appended so far
+        self.appended = []
+        # video segments requested but not appended yet, by index
+        self.pending = []
+        self.requested = set()
+        self.done = set()
+        # set when a segment is requested behind one that was already appended
+        self.out_of_order = False
+        self.last_index = -1
+        # the track files, kept open while appending
+        self.outfiles = None
+        self.events = queue.Queue()
+        for path in (self.video_stream, self.audio_stream):
+            if os.path.isfile(path):
+                os.remove(path)
+        self.thread = threading.Thread(target=self._run, name='assembler')
+        self.thread.daemon = True
+        # segments a resumed download completed before
+        if os.path.isdir(segments_path):
+            for name in sorted(os.listdir(segments_path), key=_get_file_index):
+                if name.endswith(('.m4v', '.m4a')):
+                    self.segment_requested(name)
+                    self.segment_done(name)
+        self.thread.start()
+
+    def segment_requested(self, name):
+        self.events.put(('requested', name))
+
+    def segment_done(self, name):
+        self.events.put(('done', name))
+
+    def finish(self):
+        """
+        Waits for the reported segments and appends the ones still held back.
+        With parts, the last one is muxed and the saved part files are returned.
+        """
+        self.events.put(None)
+        self.thread.join()
+        while self.pending and not self.out_of_order:
+            self._append(heapq.heappop(self.pending)[1])
+        if self.outfiles:
+            if self.rolling:
+                self._close_part()
+            else:
+                for outfile in self.outfiles:
+                    outfile.close()
+                self.outfiles = None
+                self.manifest.save()
+        if not self.rolling:
+            return []
+        self.muxer.shutdown(wait=True)
+        saved = [part.result() for part in self.parts if part.result()]
+        if len(saved) == len(self.parts) and not self.late:
+            # no segments are left for assemble(), which would need the init segments
+            for track in AssemblyManifest.TRACKS:
+                init_path = os.path.join(self.segments_path, INIT_FORMAT.format(self.stream_id, track))
+                if os.path.isfile(init_path):
+                    os.remove(init_path)
+        return saved
+
+    def _run(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            kind, name = event
+            if kind == 'requested':
+                # prefetched segments are reported again once the mpd lists them
+                if name.endswith('.m4v') and name not in self.requested:
+                    self.requested.add(name)
+                    index = _get_file_index(name)
+                    if index < self.last_index and self.rolling:
+                        logger.warn('Segment {0!s} came in after later ones were written, it is left out of '
+                                    'the parts.'.format(name))
+                        self.late.append(name)
+                        continue
+                    if index < self.last_index:
+                        self.out_of_order = True
+                    heapq.heappush(self.pending, (index, name))
+            else:
+                self.done.add(name)
+            while (self.pending and not self.out_of_order and self.pending[0][1] in self.done
+                   and self.pending[0][1].replace('.m4v', '.m4a') in self.done):
+                self._append(heapq.heappop(self.pending)[1])
+
+    def _append(self, name):
+        self.last_index = max(self.last_index, _get_file_index(name))
+        self.done.discard(name)
+        self.done.discard(name.replace('.m4v', '.m4a'))
+        if self.rolling:
+            self.part_names.append(name)
+        action, pair = _resolve_segment(os.path.join(self.segments_path, name))
+        if action == 'skipped' and self.rolling:
+            # the segment is left out, the init segment the downloader wrote into it is not
+            for track, source in zip(AssemblyManifest.TRACKS, pair):
+                self._learn_init(track, source)
+        if action != 'append':
             return
-        if not os.path.isfile(globals.download.data_json_path):
-            logger.warn("No matching JSON file found for the segment directory, trying to continue without it.")
-            ass_stream_id = os.listdir(globals.download.segments_path)[0].split('-')[0]
-            livestream_info['id'] = ass_stream_id
-            livestream_info['broadcast_status'] = "active"
-            livestream_info['segments'] = {}
-        else:
-            with open(globals.download.data_json_path) as info_file:
-                try:
-                    livestream_info = json.load(info_file)
-                except Exception as e:
-                    logger.warn("Could not load JSON file, trying to continue without it.")
-                    ass_stream_id = os.listdir(globals.download.segments_path)[0].split('-')[0]
-                    livestream_info['id'] = ass_stream_id
-                    livestream_info['broadcast_status'] = "active"
-                    livestream_info['segments'] = {}
-
-        stream_id = str(livestream_info.get('id', ''))
-        if not stream_id:
-            json_basename = os.path.splitext(os.path.basename(globals.download.data_json_path))[0]
-            for part in json_basename.split('_'):
-                if part.isdigit() and len(part) > 10:
-                    stream_id = part
-                    break
-
-        segment_meta = livestream_info.get('segments', {})
-        if segment_meta:
-            all_segments = [
-                os.path.join(globals.download.segments_path, k)
-                for k in livestream_info['segments'].keys()]
-        else:
-            all_segments = list(filter(os.path.isfile,glob.glob(os.path.join(globals.download.segments_path, '%s*.m4v' % stream_id))))
-
-        all_segments = sorted(all_segments, key=lambda x: _get_file_index(x))
-        sources = []
-        audio_stream_format = 'assembled_source_{0}_{1}_mp4.tmp'
-        video_stream_format = 'assembled_source_{0}_{1}_m4a.tmp'
-        video_stream = ''
-        audio_stream = ''
-        has_skipped_zero_m4v = False
-        has_missing_segments = False
-
-        if not all_segments:
-            logger.error("Could not assemble segments: The segment directory does not contain any files.")
+        try:
+            if self.outfiles is None:
+                self.outfiles = [open(self.video_stream, 'wb', buffering=0),
+                                 open(self.audio_stream, 'wb', buffering=0)]
+                self.part_started = time.time()
+            for track, source, outfile in zip(AssemblyManifest.TRACKS, pair, self.outfiles):
+                if self.rolling and not self._learn_init(track, source) and not outfile.tell() \
+                        and track in self.inits:
+                    outfile.write(self.inits[track])
+                _append_segment(outfile, source, self.manifest.ranges[track])
+            self.appended.append(pair)
+        except (IOError, OSError) as e:
+            logger.warn('Could not append segment {0!s}: {1!s}'.format(name, e))
+            # assemble() appends the rest
+            self.out_of_order = True
             return
+        if self.rolling and self._part_full():
+            self._close_part()
 
-        for segment in all_segments:
-            segment = re.sub('\?.*$', '', segment)
-            if not os.path.isfile(segment) or not os.path.isfile(segment.replace('.m4v', '.m4a')):
-                logger.warn('Stream segment not found: {0!s}'.format(os.path.basename(segment)))
-                has_missing_segments = True
-                continue
+    def _learn_init(self, track, source):
+        """Keeps the init segment source starts with, returns whether it has one"""
+        init = _init_prefix(source)
+        if init is None:
+            return False
+        if init != self.inits.get(track):
+            self.inits[track] = init
+            _write_init(self.segments_path, self.stream_id, track, init)
+        return True
 
-            if segment.endswith('-init.m4v'):
-                logger.info('Replacing %s' % segment)
-                segment = os.path.join(
-                    os.path.dirname(os.path.realpath(__file__)), 'repair', 'init.m4v')
-
-            if segment.endswith('-0.m4v') and not retry_with_zero_m4v:
-                has_skipped_zero_m4v = True
-                continue
-
-            video_stream = os.path.join(
-                globals.download.segments_path, video_stream_format.format(stream_id, len(sources)))
-            audio_stream = os.path.join(
-                globals.download.segments_path, audio_stream_format.format(stream_id, len(sources)))
-
-
-            file_mode = 'ab'
-
-            with open(video_stream, file_mode) as outfile, open(segment, 'rb') as readfile:
-                shutil.copyfileobj(readfile, outfile)
-
-            with open(audio_stream, file_mode) as outfile, open(segment.replace('.m4v', '.m4a'), 'rb') as readfile:
-                shutil.copyfileobj(readfile, outfile)
-
-        if audio_stream and video_stream:
-            sources.append({'video': video_stream, 'audio': audio_stream})
-
-        for n, source in enumerate(sources):
-            ffmpeg_binary = globals.config.ffmpeg_path
-            cmd = [
-                ffmpeg_binary, '-loglevel', 'error', '-y',
-                '-i', source['audio'],
-                '-i', source['video'],
-                '-c:v', 'copy', '-c:a', 'copy', globals.download.video_path]
-            #fnull = open(os.devnull, 'w')
-            fnull = None
-            exit_code = subprocess.call(cmd, stdout=fnull, stderr=subprocess.STDOUT)
-            if exit_code != 0:
-                logger.warn("FFmpeg exit code not '0' but '{:d}'.".format(exit_code))
-                if has_skipped_zero_m4v and not retry_with_zero_m4v:
-                    logger.binfo("*-0.m4v segment was detected but skipped, retrying to assemble video without "
-                                 "skipping it.")
-                    os.remove(source['audio'])
-                    os.remove(source['video'])
-                    assemble(retry_with_zero_m4v=True)
-                    
+    def _part_full(self):
+        if self.part_seconds and time.time() - self.part_started >= self.part_seconds:
+            return True
+        return bool(self.part_bytes) and self.manifest.end('video') + self.manifest.end('audio') >= self.part_bytes
+
+    def _close_part(self):
+        """Hands the current part to the muxer thread and starts the next one"""
+        for outfile in self.outfiles:
+            outfile.close()
+        self.outfiles = None
+        self.parts.append(self.muxer.submit(
+            self._mux_part, self.part, self.video_stream, self.audio_stream, self.part_names))
+        self.part += 1
+        self.part_names = []
+        self.video_stream = os.path.join(self.segments_path, VIDEO_STREAM_FORMAT.format(self.stream_id, self.part))
+        self.audio_stream = os.path.join(self.segments_path, AUDIO_STREAM_FORMAT.format(self.stream_id, self.part))
+        self.manifest = AssemblyManifest(self.segments_path, self.stream_id)
+
+    def _mux_part(self, part, video_stream, audio_stream, names):
+        output_path = PART_FORMAT.format(self.segments_path, part)
+        exit_code = _mux(video_stream, audio_stream, output_path)
+        if exit_code != 0:
+            logger.error('Could not save part {0:d}, its segments are kept: {1!s}'.format(
+                part, 'FFmpeg is not available.' if exit_code is None else
+                "FFmpeg exit code not '0' but '{0:d}'.".format(exit_code)))
+            # assemble() builds its own track files from the segments
+            for path in (video_stream, audio_stream):
+                if os.path.isfile(path):
+                    os.remove(path)
+            return None
+        # the part is complete, its segments are not needed anymore
+        for path in [video_stream, audio_stream] + [os.path.join(self.segments_path, segment_name)
+                                                    for name in names
+                                                    for segment_name in (name, name.replace('.m4v', '.m4a'))]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        logger.info('Saved part {0:d}: {1!s}'.format(part, os.path.basename(output_path)))
+        return output_path
+
+
+def _build_track(track_path, sources, ranges=None, reused=0):
+    """Concatenates sources into the track file, keeping the first reused ones already in it"""
+    ranges = [] if ranges is None else ranges
+    with open(track_path, 'r+b' if reused else 'wb', buffering=0) as outfile:
+        if reused:
+            end = ranges[-1][1] + ranges[-1][2]
+            outfile.truncate(end)
+            outfile.seek(end)
+        for source in sources[reused:]:
+            _append_segment(outfile, source, ranges)
+
+
+def _mux(video_stream, audio_stream, output_path, heads=None):
+    """
+    Muxes the track files into output_path, with FFmpeg if the remuxer cannot
+    handle them. heads are (video, audio) files read before the track files.
+    Returns the exit code, None if FFmpeg is needed but missing.
+    """
+    inputs = [[stream] if head is None else [head, stream]
+              for head, stream in zip(heads or (None, None), (video_stream, audio_stream))]
+    try:
+        remux.remux(inputs[0], inputs[1], output_path)
+        return 0
+    except (remux.UnsupportedInput, struct.error, IOError, OSError) as e:
+        logger.warn('Could not remux the segments, falling back to FFmpeg: {0!s}'.format(e))
+    if not globals.config.ffmpeg_path:
+        return None
+    # the concat protocol reads the files of a track as one
+    video_input, audio_input = [paths[0] if len(paths) == 1 else 'concat:' + '|'.join(paths) for paths in inputs]
+    ffmpeg_binary = globals.config.ffmpeg_path
+    cmd = [
+        ffmpeg_binary, '-loglevel', 'error', '-y',
+        '-i', audio_input,
+        '-i', video_input,
+        '-c:v', 'copy', '-c:a', 'copy', output_path]
+    #fnull = open(os.devnull, 'w')
+    fnull = None
+    return subprocess.call(cmd, stdout=fnull, stderr=subprocess.STDOUT)
+
+
+def _log_missing(track, names, limit=10):
+    names = sorted(names, key=_get_file_index)
+    listed = ', '.join(names[:limit])
+    if len(names) > limit:
+        listed += ' and {0:d} more'.format(len(names) - limit)
+    logger.warn('{0:d} segment(s) missing from the {1!s} track: {2!s}'.format(len(names), track, listed))
+
+
+def assemble(retry_with_zero_m4v=False, generate_video_path=None):
+    """
+    Assembles the segments of globals.download, or of the segment folder or
+    JSON file given to -gv. Returns True once the video file was saved.
+    """
+    logger.binfo('Assembling segments into video file.')
+    logger.separator()
+    if generate_video_path:
+        globals.download = Download()
+        globals.download.segments_path = generate_video_path if not generate_video_path.endswith(".json") else generate_video_path.replace(".json", "")
+        globals.download.data_json_path = generate_video_path if generate_video_path.endswith(".json") else generate_video_path + ".json"
+        globals.download.video_path = globals.download.segments_path + ".mp4"
+
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            result = _assemble(retry_with_zero_m4v)
+            if result != RETRY_WITH_ZERO_M4V:
+                return result is True
+            retry_with_zero_m4v = True
+        except ValueError as e:
+            logger.separator()
+            logger.error('Could not assemble segments: {:s}'.format(str(e)))
+            if not os.listdir(globals.download.segments_path):
+                logger.error("Segment directory is empty. There is nothing to assemble.")
+                return False
+            if attempt < MAX_ATTEMPTS:
+                logger.binfo("Segment directory is not empty. Trying to assemble again.")
+        except Exception as e:
+            logger.separator()
+            logger.error('Could not assemble segments: {:s}'.format(str(e)))
+            return False
+    logger.error("Could not assemble segments after {0:d} attempts. The track files are kept, the next "
+                 "attempt continues from them.".format(MAX_ATTEMPTS))
+    return False
+
+
+def _assemble(retry_with_zero_m4v):
+    """
+    One attempt of assemble(), returns True once the video file was saved or
+    RETRY_WITH_ZERO_M4V to try again with that segment.
+    """
+    livestream_info = {}
+    if not os.path.isdir(globals.download.segments_path):
+        logger.error("Could not assemble segments: The segment directory does not exist.")
+        return
+    # the only listing of the directory, every existence check below uses it
+    files = set(entry.name for entry in os.scandir(globals.download.segments_path) if entry.is_file())
+    # the positions the downloader recorded, it also lists segments that were released into parts
+    segments = manifest.read(globals.download.segments_path) or []
+    positions = dict((segment.name, segment.time) for segment in segments if segment.name in files)
+    released = set(segment.name for segment in segments) - files
+    if not files:
+        logger.error("Could not assemble segments: The segment directory does not contain any files.")
+        return
+    if not os.path.isfile(globals.download.data_json_path):
+        logger.warn("No matching JSON file found for the segment directory, trying to continue without it.")
+        ass_stream_id = sorted(files)[0].split('-')[0]
+        livestream_info['id'] = ass_stream_id
+        livestream_info['broadcast_status'] = "active"
+        livestream_info['segments'] = {}
+    else:
+        with open(globals.download.data_json_path) as info_file:
+            try:
+                livestream_info = json.load(info_file)
+            except Exception as e:
+                logger.warn("Could not load JSON file, trying to continue without it.")
+                ass_stream_id = sorted(files)[0].split('-')[0]
+                livestream_info['id'] = ass_stream_id
+                livestream_info['broadcast_status'] = "active"
+                livestream_info['segments'] = {}
+
+    stream_id = str(livestream_info.get('id', ''))
+    if not stream_id:
+        json_basename = os.path.splitext(os.path.basename(globals.download.data_json_path))[0]
+        for part in json_basename.split('_'):
+            if part.isdigit() and len(part) > 10:
+                stream_id = part
+                break
+
+    track_manifest = AssemblyManifest.load(globals.download.segments_path, stream_id)
+
+    segment_meta = livestream_info.get('segments', {})
+    if segment_meta:
+        all_segments = [
+            os.path.join(globals.download.segments_path, k)
+            for k in livestream_info['segments'].keys()]
+    else:
+        all_segments = [os.path.join(globals.download.segments_path, name) for name in files
+                        if name.startswith(stream_id) and name.endswith('.m4v')]
+
+    all_segments = sorted(all_segments, key=lambda x: positions.get(os.path.basename(x), _get_file_index(x)))
+    sources = []
+    video_stream = ''
+    audio_stream = ''
+    has_skipped_zero_m4v = False
+    has_missing_segments = False
+    heads = None
+
+    if not all_segments:
+        logger.error("Could not assemble segments: The segment directory does not contain any files.")
+        return
+
+    pairs = []
+    missing_video = []
+    missing_audio = []
+    released_count = 0
+    for segment in all_segments:
+        action, pair = _resolve_segment(segment, files)
+        if action == 'missing' and all(os.path.basename(path) in released for path in pair):
+            released_count += 1
+        elif action == 'missing':
+            # the segment is left out of both tracks to keep them aligned
+            video_name, audio_name = os.path.basename(pair[0]), os.path.basename(pair[1])
+            if video_name not in files:
+                missing_video.append(video_name)
+            if audio_name not in files:
+                missing_audio.append(audio_name)
+            has_missing_segments = True
+        elif action == 'skipped':
+            has_skipped_zero_m4v = True
+            # the segment is read before the track files, so they are the same with and without it
+            if retry_with_zero_m4v:
+                heads = pair
             else:
-                os.remove(source['audio'])
-                os.remove(source['video'])
-                if has_missing_segments:
-                    logger.separator()
-                    logger.warn("One or more segments were missing. The video file may be malformed.")
-                    logger.separator()
-                logger.info('Successfully saved video file: %s' % os.path.basename(globals.download.video_path))
-    except ValueError as e:
-        logger.separator()
-        logger.error('Could not assemble segments: {:s}'.format(str(e)))
-        if os.listdir(globals.download.segments_path):
-            logger.binfo("Segment directory is not empty. Trying to assemble again.")
-            assemble()
+                # the downloader wrote the init segment into it, the tracks start with that instead
+                heads = _save_inits(globals.download.segments_path, stream_id, pair)
+        else:
+            if pair[0] == REPAIR_INIT:
+                logger.info('Replacing %s' % segment)
+            pairs.append(pair)
+    if released_count:
+        logger.info('{0:d} segment(s) were removed after downloading, like the ones saved into parts, '
+                    'they are left out.'.format(released_count))
+    if pairs and heads is None and _init_prefix(pairs[0][0]) is None:
+        # the first segments of a recording saved in parts were released, it kept their init segments
+        init_paths = tuple(os.path.join(globals.download.segments_path, INIT_FORMAT.format(stream_id, track))
+                           for track in AssemblyManifest.TRACKS)
+        if all(os.path.isfile(path) for path in init_paths):
+            heads = init_paths
+    if missing_video:
+        _log_missing('video', missing_video)
+    if missing_audio:
+        _log_missing('audio', missing_audio)
+    if has_missing_segments:
+        logger.warn('{0:d} of {1:d} segment(s) are complete in both tracks.'.format(len(pairs), len(all_segments)))
+
+    if pairs:
+        video_stream = os.path.join(
+            globals.download.segments_path, VIDEO_STREAM_FORMAT.format(stream_id, len(sources)))
+        audio_stream = os.path.join(
+            globals.download.segments_path, AUDIO_STREAM_FORMAT.format(stream_id, len(sources)))
+
+    if pairs:
+        tracks = [('video', video_stream, [pair[0] for pair in pairs]),
+                  ('audio', audio_stream, [pair[1] for pair in pairs])]
+        reused = [track_manifest.reusable(track, path, track_sources) for track, path, track_sources in tracks]
+        if reused == [len(pairs)] * 2:
+            logger.info('Using the track files assembled before.')
         else:
-            logger.error("Segment directory is empty. There is nothing to assemble.")
-    except Exception as e:
-        logger.separator()
-        logger.error('Could not assemble segments: {:s}'.format(str(e)))
\ No newline at end of file
+            if any(reused):
+                logger.info('Reusing {0:d} video and {1:d} audio segment(s) assembled before.'.format(*reused))
+            try:
+                # the tracks are independent files, build them side by side
+                with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                    builds = [executor.submit(_build_track, path, track_sources, track_manifest.ranges[track], count)
+                              for (track, path, track_sources), count in zip(tracks, reused)]
+                    for build in builds:
+                        build.result()
+            finally:
+                # what was appended is kept for the next attempt
+                track_manifest.save()
+
+    if audio_stream and video_stream:
+        sources.append({'video': video_stream, 'audio': audio_stream})
+
+    for n, source in enumerate(sources):
+        exit_code = _mux(source['video'], source['audio'], globals.download.video_path, heads)
+        if exit_code is not None and exit_code != 0:
+            logger.warn("FFmpeg exit code not '0' but '{:d}'.".format(exit_code))
+        if exit_code != 0 and has_skipped_zero_m4v and not retry_with_zero_m4v:
+            logger.binfo("*-0.m4v segment was detected but skipped, retrying to assemble video without "
+                         "skipping it.")
+            return RETRY_WITH_ZERO_M4V
+        if exit_code is None:
+            logger.error("Could not assemble segments: FFmpeg is not available. The track files are "
+                         "kept in the segment directory.")
+        elif exit_code == 0:
+            os.remove(source['audio'])
+            os.remove(source['video'])
+            for track in AssemblyManifest.TRACKS:
+                init_path = os.path.join(globals.download.segments_path, INIT_FORMAT.format(stream_id, track))
+                if os.path.isfile(init_path):
+                    os.remove(init_path)
+            track_manifest.remove()
+            if has_missing_segments:
+                logger.separator()
+                logger.warn("One or more segments were missing. The video file may be malformed.")
+                logger.separator()
+            logger.info('Successfully saved video file: %s' % os.path.basename(globals.download.video_path))
+            return True
@@ -0,0 +1,172 @@
+"""
+Assembles several segment folders at once for -gv.
+
+Every folder is a job that runs assembler.assemble() in a worker process.
+Jobs are started largest first, and a large job only starts while no other
+large job is running on the same disk (st_dev), so big assemblies do not
+compete for one disk while small jobs and jobs on other disks fill the
+remaining workers. The output of a job is collected in its worker and
+printed as one block once the job finished.
+"""
+import concurrent.futures
+import contextlib
+import glob
+import io
+import os
+import time
+
+from . import assembler
+from . import globals
+from . import logger
+
+# a job above this size does not share its disk with another one
+LARGE_JOB_BYTES = 1024 * 1024 * 1024
+# a locked folder the download did not write to for this long was left behind by a crash
+STALE_LOCK_SECONDS = 5 * 60
+
+
+def _segments_path(path):
+    return path[:-len('.json')] if path.endswith('.json') else path
+
+
+def _stale_lock(path, lock):
+    """
+    True for a folder lock left behind by a crash. A download holds the
+    user lock in the download path as well and keeps writing segments.
+    """
+    if not os.path.isfile(os.path.join(globals.config.download_path, lock)):
+        return True
+    try:
+        return time.time() - os.stat(path).st_mtime > STALE_LOCK_SECONDS
+    except OSError:
+        return True
+
+
+def discover():
+    """The segment folders in the download path without a video file, skipping the ones still being downloaded"""
+    paths = []
+    for entry in sorted(os.scandir(globals.config.download_path), key=lambda entry: entry.name):
+        if not entry.is_dir() or not entry.name.endswith('_live'):
+            continue
+        if os.path.isfile(entry.path + '.mp4'):
+            continue
+        names = os.listdir(entry.path)
+        locks = [name for name in names if name.endswith('.lock')]
+        if locks and not all(_stale_lock(entry.path, lock) for lock in locks):
+            continue
+        for lock in locks:
+            logger.warn('Ignoring the lock file left behind in {:s}: {:s}'.format(entry.name, lock))
+        # recorded in parts, which were saved while downloading, unless segments were left over
+        if glob.glob(glob.escape(entry.path) + '_part[0-9][0-9][0-9].mp4') \
+                and not any(name.endswith('.m4v') for name in names):
+            continue
+        paths.append(entry.path)
+    return paths
+
+
+def resolve_paths(patterns):
+    """
+    The segment folders to assemble for the paths and glob patterns given to
+    -gv, every unassembled folder in the download path if none were given.
+    """
+    if not patterns:
+        return discover()
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.escape(pattern) != pattern else [pattern]
+        for path in matches:
+            path = _segments_path(path)
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
+def _job_size(path):
+    # the files present, the manifest still counts the segments released into parts
+    try:
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+    except OSError:
+        return 0
+
+
+def _job_device(path):
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+
+def _run_job(path, settings):
+    """Runs in a worker process, returns (succeeded, seconds, output)"""
+    globals.init()
+    for name, value in settings.items():
+        setattr(globals.config, name, value)
+    # the main process prints the output and writes it to the log file
+    globals.config.log_to_file = False
+    logger.SUPP_COLOR = False
+    output = io.StringIO()
+    started = time.time()
+    with contextlib.redirect_stdout(output):
+        try:
+            succeeded = assembler.assemble(generate_video_path=path)
+        except Exception as e:
+            logger.error('Could not assemble segments: {:s}'.format(str(e)))
+            succeeded = False
+    return succeeded, time.time() - started, output.getvalue()
+
+
+def assemble_all(paths):
+    """Assembles the segment folders in worker processes, returns the paths that failed"""
+    workers = max(1, min(globals.config.assemble_workers, len(paths)))
+    settings = dict((name, value) for name, value in vars(globals.config).items()
+                    if not name.startswith('_') and name != 'parser_object')
+    # largest first, so the long jobs do not end up running last
+    pending = sorted(((_job_size(path), path) for path in paths), reverse=True)
+    pending = [(size, _job_device(path), path) for size, path in pending]
+    logger.info('Assembling {:d} segment folders with {:d} worker process(es).'.format(len(pending), workers))
+    logger.separator()
+
+    running = {}
+    busy_devices = set()
+    failed = []
+    finished = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            for job in list(pending):
+                if len(running) >= workers:
+                    break
+                size, device, path = job
+                large = size >= LARGE_JOB_BYTES
+                if large and device in busy_devices:
+                    continue
+                pending.remove(job)
+                if large:
+                    busy_devices.add(device)
+                running[executor.submit(_run_job, path, settings)] = job
+                logger.info('Started assembling {:s} ({:.1f} MB).'.format(os.path.basename(path), size / 1048576.0))
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                size, device, path = running.pop(future)
+                if size >= LARGE_JOB_BYTES:
+                    busy_devices.discard(device)
+                try:
+                    succeeded, seconds, output = future.result()
+                except Exception as e:
+                    succeeded, seconds, output = False, 0.0, '[E] The worker process failed: {:s}\n'.format(str(e))
+                finished += 1
+                logger.separator()
+                for line in output.splitlines():
+                    logger.plain(line)
+                progress = '[{:d}/{:d}]'.format(finished, len(paths))
+                if succeeded:
+                    logger.info('{:s} Assembled {:s} in {:.1f} seconds.'.format(progress, os.path.basename(path), seconds))
+                else:
+                    failed.append(path)
+                    logger.error('{:s} Could not assemble {:s}.'.format(progress, os.path.basename(path)))
+                logger.separator()
+
+    logger.info('Assembled {:d} of {:d} segment folders.'.format(len(paths) - len(failed), len(paths)))
+    for path in failed:
+        logger.warn('Not assembled: {:s}'.format(path))
+    return failed
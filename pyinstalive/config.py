@@ -15,4 +15,19 @@ class Config:
     use_locks = True
     send_heartbeat = True
     proxy = None
-    cookie_file = None
\ No newline at end of file
+    cookie_file = None
+    download_workers = 8
+    download_engine = "threaded"
+    segment_fsync = "never"
+    segment_prefetch = False
+    max_resolution = 0
+    max_bitrate = 0
+    host_bandwidth_budget = 0
+    adaptive_quality = False
+    http_transport = "requests"
+    bandwidth_limit = 0
+    global_bandwidth_limit = 0
+    metrics_port = 0
+    assemble_workers = 2
+    split_minutes = 0
+    split_megabytes = 0
\ No newline at end of file
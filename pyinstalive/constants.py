@@ -20,11 +20,28 @@ use_locks = True
 send_heartbeat = True
 proxy =
 cookie_file =
+download_workers = 8
+download_engine = threaded
+segment_fsync = never
+segment_prefetch = False
+max_resolution = 0
+max_bitrate = 0
+host_bandwidth_budget = 0
+adaptive_quality = False
+http_transport = requests
+bandwidth_limit = 0
+global_bandwidth_limit = 0
+metrics_port = 0
+assemble_workers = 2
+split_minutes = 0
+split_megabytes = 0
     """
 
 
 
     BASE_HEADERS =  {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/148.0.7478.45 Safari/537.36', "x-ig-app-id": '936619743392459', "sec-ch-ua": '"Not_A Brand";v="8", "Chromium";v="148", "Google Chrome";v="148"', "sec-ch-ua-mobile": "?0", "sec-ch-ua-platform": '"Windows"', "sec-fetch-dest": "document", "sec-fetch-mode": "navigate", "sec-fetch-site": "none", "sec-fetch-user": "?1", "upgrade-insecure-requests": "1", "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8", "accept-encoding": "gzip, deflate, br", "accept-language": "en-US,en;q=0.9"}
+    # mpd and segment requests only need to look like the same client, without the browser navigation headers
+    MEDIA_HEADERS = {"accept": "*/*", "accept-encoding": "gzip, deflate", "connection": "keep-alive"}
     BASE_WEB = "https://www.instagram.com/"
     BASE_API = "https://i.instagram.com/api/v1/"
 
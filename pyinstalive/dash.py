@@ -0,0 +1,273 @@
+"""
+Parser for the subset of MPEG-DASH manifests that IG live streams use:
+Period > AdaptationSet > Representation > SegmentTemplate > SegmentTimeline.
+
+parse() tries a regex based scanner first and falls back to
+ElementTree for anything it does not expect. Both produce the same records.
+"""
+import collections
+import logging
+import re
+import xml.etree.ElementTree
+import xml.sax.saxutils
+
+logger = logging.getLogger(__file__)
+
+MPD_NAMESPACE = {'mpd': 'urn:mpeg:dash:schema:mpd:2011'}
+
+Manifest = collections.namedtuple('Manifest', [
+    'minimum_update_period', 'time_shift_buffer_depth', 'periods'])
+Period = collections.namedtuple('Period', ['id', 'adaptation_sets'])
+AdaptationSet = collections.namedtuple('AdaptationSet', ['id', 'representations'])
+Representation = collections.namedtuple('Representation', [
+    'id', 'mime_type', 'width', 'height', 'bandwidth', 'quality_label', 'sampling_rate', 'template'])
+# segments is a Timeline of (t, d) tuples with r= repeats expanded
+SegmentTemplate = collections.namedtuple('SegmentTemplate', [
+    'initialization', 'media', 'timescale', 'segments'])
+
+_TAG_RE = re.compile(
+    r'<(/?)(MPD|Period|AdaptationSet|Representation|SegmentTemplate|SegmentTimeline)\b([^<>]*)>')
+_ATTR_RE = re.compile(r'([^\s=]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+# timeline entries in the attribute order IG writes them, others go through _ATTR_RE
+_S_RE = re.compile(r'<S t="([0-9]+)" d="([0-9]+)"(?: r="([0-9]+)")?\s*/>')
+_UNSUPPORTED_MARKUP = ('<!', 'BaseURL', 'SegmentList', 'SegmentBase')
+_DURATION_RE = re.compile(
+    r'^P(?:(?P<days>[0-9.]+)D)?(?:T(?:(?P<hours>[0-9.]+)H)?(?:(?P<mins>[0-9.]+)M)?(?:(?P<secs>[0-9.]+)S)?)?$')
+_ENTITIES = {'&quot;': '"', '&apos;': "'"}
+
+
+class UnsupportedManifest(ValueError):
+    """Raised by the fast parser for manifests it cannot handle"""
+
+
+class Timeline(object):
+    """
+    SegmentTimeline entries as (t, d) tuples. The fast parser keeps the raw
+    timeline and only decodes it when iterated, while since() reads just the
+    newest entries from the end, so a poll of a large DVR window costs
+    O(new segments).
+    """
+
+    def __init__(self, body=None, entries=None):
+        self._body = body
+        self._entries = entries
+
+    def _decode(self):
+        if self._entries is None:
+            self._entries = _parse_timeline(self._body)
+        return self._entries
+
+    def __len__(self):
+        if self._entries is None:
+            return self._body.count('<S')
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._decode())
+
+    def __getitem__(self, index):
+        return self._decode()[index]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Timeline({0!r})'.format(self._decode())
+
+    def since(self, t):
+        """Returns the entries with a $Time$ greater than t (all if t is None), oldest first"""
+        if self._entries is None and 'r="' not in self._body:
+            entries = []
+            end = len(self._body)
+            while True:
+                pos = self._body.rfind('<S', 0, end)
+                if pos < 0:
+                    break
+                mobj = _S_RE.match(self._body, pos)
+                if not mobj:
+                    # unusual attribute order, decode the whole timeline
+                    entries = None
+                    break
+                entry_time = int(mobj.group(1))
+                if t is not None and entry_time <= t:
+                    break
+                entries.append((entry_time, int(mobj.group(2))))
+                end = pos
+            if entries is not None:
+                entries.reverse()
+                return entries
+
+        entries = self._decode()
+        start = len(entries)
+        while start > 0 and (t is None or entries[start - 1][0] > t):
+            start -= 1
+        return entries[start:]
+
+
+def parse_duration(duration, default=None):
+    """Returns an ISO 8601 duration such as PT1.5S in seconds"""
+    mobj = _DURATION_RE.match(duration or '')
+    if not mobj or not any(mobj.groups()):
+        return default
+    parts = dict((k, float(v)) for k, v in mobj.groupdict().items() if v)
+    return (parts.get('days', 0) * 86400 + parts.get('hours', 0) * 3600 +
+            parts.get('mins', 0) * 60 + parts.get('secs', 0))
+
+
+def parse(content):
+    """Parses the mpd bytes into a Manifest"""
+    try:
+        return parse_fast(content)
+    except (UnsupportedManifest, ValueError, KeyError, UnicodeDecodeError) as e:
+        logger.debug('Falling back to ElementTree for mpd: {0!s}'.format(e))
+        return parse_etree(content)
+
+
+def _attributes(raw):
+    attrs = {}
+    for name, dq, sq in _ATTR_RE.findall(raw):
+        value = dq or sq
+        if '&' in value:
+            value = xml.sax.saxutils.unescape(value, _ENTITIES)
+            if '&#' in value:
+                raise UnsupportedManifest('character reference in attribute {0!s}'.format(name))
+        attrs[name] = value
+    return attrs
+
+
+def _expand_timeline(entries):
+    segments = []
+    end = 0
+    for attrs in entries:
+        t = int(attrs['t']) if 't' in attrs else end
+        d = int(attrs['d'])
+        for _ in range(int(attrs.get('r', 0)) + 1):
+            segments.append((t, d))
+            t += d
+        end = t
+    return segments
+
+
+def _parse_timeline(body):
+    entries = _S_RE.findall(body)
+    if len(entries) != body.count('<S'):
+        return _expand_timeline(_attributes(raw) for raw in re.findall(r'<S\b([^<>]*?)/?>', body))
+    if 'r="' in body:
+        return _expand_timeline({'t': t, 'd': d, 'r': r or 0} for t, d, r in entries)
+    return [(int(t), int(d)) for t, d, _ in entries]
+
+
+def _representation(attrs, template_attrs, segments):
+    return Representation(
+        id=attrs.get('id', ''),
+        mime_type=attrs.get('mimeType', ''),
+        width=int(attrs.get('width', 0)),
+        height=int(attrs.get('height', 0)),
+        bandwidth=int(attrs.get('bandwidth', 0)),
+        quality_label=attrs.get('FBQualityLabel', ''),
+        sampling_rate=int(attrs.get('audioSamplingRate', 0)),
+        template=SegmentTemplate(
+            initialization=template_attrs.get('initialization', ''),
+            media=template_attrs.get('media', ''),
+            timescale=int(template_attrs.get('timescale', 1)),
+            segments=segments))
+
+
+def _manifest(attrs, periods):
+    return Manifest(
+        minimum_update_period=parse_duration(attrs.get('minimumUpdatePeriod'), 1),
+        time_shift_buffer_depth=parse_duration(attrs.get('timeShiftBufferDepth')),
+        periods=periods)
+
+
+def parse_fast(content):
+    """
+    Parses the mpd by scanning for the few structural elements and matching
+    timeline entries in bulk. Raises UnsupportedManifest for anything unexpected.
+    """
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+    for markup in _UNSUPPORTED_MARKUP:
+        if markup in content:
+            raise UnsupportedManifest('unsupported markup {0!s}'.format(markup))
+
+    mpd_attrs = None
+    periods = []
+    stack = []
+    adaptation_sets = representations = None
+    rep_attrs = template_attrs = segments = None
+
+    pos = 0
+    while True:
+        mobj = _TAG_RE.search(content, pos)
+        if not mobj:
+            break
+        pos = mobj.end()
+        closing, tag, raw = mobj.groups()
+        self_closing = raw.endswith('/')
+
+        if closing:
+            if not stack or stack.pop() != tag:
+                raise UnsupportedManifest('unbalanced element {0!s}'.format(tag))
+            if tag == 'Representation':
+                if template_attrs is None:
+                    raise UnsupportedManifest('representation without segment template')
+                representations.append(_representation(
+                    rep_attrs, template_attrs, segments or Timeline(entries=[])))
+            continue
+
+        attrs = _attributes(raw)
+        parent = stack[-1] if stack else None
+        if tag == 'MPD' and parent is None:
+            mpd_attrs = attrs
+        elif tag == 'Period' and parent == 'MPD':
+            adaptation_sets = []
+            periods.append(Period(attrs.get('id'), adaptation_sets))
+        elif tag == 'AdaptationSet' and parent == 'Period':
+            representations = []
+            adaptation_sets.append(AdaptationSet(attrs.get('id'), representations))
+        elif tag == 'Representation' and parent == 'AdaptationSet' and not self_closing:
+            rep_attrs, template_attrs, segments = attrs, None, None
+        elif tag == 'SegmentTemplate' and parent == 'Representation':
+            template_attrs = attrs
+        elif tag == 'SegmentTimeline' and parent == 'SegmentTemplate':
+            if self_closing:
+                segments = Timeline(entries=[])
+                continue
+            end = content.find('</SegmentTimeline>', pos)
+            if end < 0:
+                raise UnsupportedManifest('unterminated SegmentTimeline')
+            segments = Timeline(body=content[pos:end])
+            pos = end + len('</SegmentTimeline>')
+            continue
+        else:
+            raise UnsupportedManifest('unexpected element {0!s}'.format(tag))
+
+        if not self_closing:
+            stack.append(tag)
+
+    if mpd_attrs is None or stack:
+        raise UnsupportedManifest('incomplete mpd')
+    return _manifest(mpd_attrs, periods)
+
+
+def parse_etree(content):
+    """Parses the mpd with ElementTree"""
+    mpd = xml.etree.ElementTree.fromstring(content)
+    periods = []
+    for period in mpd.findall('mpd:Period', MPD_NAMESPACE):
+        adaptation_sets = []
+        for adaptation_set in period.findall('mpd:AdaptationSet', MPD_NAMESPACE):
+            representations = []
+            for representation in adaptation_set.findall('mpd:Representation', MPD_NAMESPACE):
+                segment_template = representation.find('mpd:SegmentTemplate', MPD_NAMESPACE)
+                segment_timeline = segment_template.find('mpd:SegmentTimeline', MPD_NAMESPACE)
+                segments = Timeline(entries=[] if segment_timeline is None else _expand_timeline(
+                    s.attrib for s in segment_timeline.findall('mpd:S', MPD_NAMESPACE)))
+                representations.append(_representation(representation.attrib, segment_template.attrib, segments))
+            adaptation_sets.append(AdaptationSet(adaptation_set.attrib.get('id'), representations))
+        periods.append(Period(period.attrib.get('id'), adaptation_sets))
+    return _manifest(mpd.attrib, periods)
@@ -4,8 +4,10 @@ from . import globals
 from . import api
 from . import assembler
 from . import live
+from . import live_async
 from .constants import Constants
 
+import glob
 import json
 import threading
 import os
@@ -25,6 +27,7 @@ class Download:
         self.livestream_guest = None
         self.livestream_owner = None
         self.tasks_worker = None
+        self.incremental_assembler = None
         self.download_stop = False
 
     def start(self):
@@ -140,19 +143,37 @@ class Download:
         try:
             mpd_url = self.livestream_object_init.get('dash_abr_playback_url')
 
-            self.video_path = os.path.join(globals.config.download_path, '{}_{}_{}_{}_live.mp4'.format(helpers.strdatetime_compat(), self.download_user,
-                                                        self.livestream_object_init.get('id'), self.timestamp))
-
-            self.segments_path = os.path.join(globals.config.download_path, '{}_{}_{}_{}_live'.format(helpers.strdatetime_compat(), self.download_user,
-                                                        self.livestream_object_init.get('id'), self.timestamp))
+            resume_path = self.get_resumable_segments_path()
+            if resume_path:
+                # continue into the recording of the interrupted run, including its start time
+                self.segments_path = resume_path
+                self.timestamp = resume_path[:-len('_live')].rsplit('_', 1)[1]
+                logger.binfo("Resuming the interrupted download in: {:s}".format(os.path.basename(resume_path)))
+                logger.separator()
+            else:
+                self.segments_path = os.path.join(globals.config.download_path, '{}_{}_{}_{}_live'.format(helpers.strdatetime_compat(), self.download_user,
+                                                            self.livestream_object_init.get('id'), self.timestamp))
 
-            self.data_generate_comments_path = os.path.join(globals.config.download_path, '{}_{}_{}_{}_live.log'.format(helpers.strdatetime_compat(), self.download_user,
-                                                        self.livestream_object_init.get('id'), self.timestamp))
+            self.video_path = self.segments_path + '.mp4'
+            self.data_generate_comments_path = self.segments_path + '.log'
+            self.data_json_path = self.segments_path + '.json'
 
-            self.data_json_path = os.path.join(globals.config.download_path, '{}_{}_{}_{}_live.json'.format(helpers.strdatetime_compat(), self.download_user,
-                                                        self.livestream_object_init.get('id'), self.timestamp))
+            if resume_path and globals.config.download_comments and os.path.isfile(self.data_json_path):
+                try:
+                    with open(self.data_json_path) as json_file:
+                        globals.comments.comments = json.load(json_file).get("comments", [])
+                except Exception as e:
+                    logger.warn("Could not restore the comments of the interrupted download: {:s}".format(str(e)))
                                                        
-            self.downloader_object = live.Downloader(
+            if not globals.config.no_assemble:
+                # concatenates the segments while they come in, leaving only the mux for the end
+                self.incremental_assembler = assembler.IncrementalAssembler(
+                    self.segments_path, self.livestream_object_init.get('id'),
+                    part_seconds=globals.config.split_minutes * 60,
+                    part_bytes=globals.config.split_megabytes * 1024 * 1024)
+
+            downloader_class = live_async.AsyncDownloader if globals.config.download_engine == "async" else live.Downloader
+            self.downloader_object = downloader_class(
                 mpd=mpd_url,
                 output_dir=self.segments_path,
                 max_connection_error_retry=3,
@@ -160,6 +181,21 @@ class Download:
                 mpd_download_timeout=3,
                 callback_check=self.update_stream_data,
                 download_timeout=3,
+                max_download_workers=globals.config.download_workers,
+                fsync_policy=globals.config.segment_fsync,
+                prefetch=globals.config.segment_prefetch,
+                max_resolution=globals.config.max_resolution,
+                # bitrates are configured in kbit/s
+                max_bitrate=globals.config.max_bitrate * 1000,
+                host_bandwidth_budget=globals.config.host_bandwidth_budget * 1000,
+                adaptive_quality=globals.config.adaptive_quality,
+                http_transport=globals.config.http_transport,
+                # bandwidth limits are configured in KB/s
+                bandwidth_limit=globals.config.bandwidth_limit * 1024,
+                global_bandwidth_limit=globals.config.global_bandwidth_limit * 1024,
+                bandwidth_state_path=os.path.join(globals.config.download_path, '.pyinstalive_bandwidth'),
+                resume=bool(resume_path),
+                segment_listener=self.incremental_assembler,
                 ffmpeg_binary=globals.config.ffmpeg_path)
 
             self.livestream_owner = self.livestream_object_init.get('broadcast_owner').get("username")
@@ -212,6 +248,13 @@ class Download:
                 self.downloader_object.stop()
             self.finish_download()
 
+    def get_resumable_segments_path(self):
+        # an interrupted download of the same broadcast leaves its segment folder with a checkpoint
+        pattern = '*_{}_{}_*_live'.format(glob.escape(self.download_user), glob.escape(str(self.livestream_object_init.get('id'))))
+        candidates = [path for path in glob.glob(os.path.join(globals.config.download_path, pattern))
+                      if os.path.isfile(os.path.join(path, live.Downloader.CHECKPOINT_FILE))]
+        return max(candidates, key=os.path.getmtime) if candidates else None
+
     def finish_download(self):
         try:
             self.livestream_object['initial_buffered_duration'] = self.downloader_object.initial_buffered_duration
@@ -238,7 +281,19 @@ class Download:
                 logger.separator()
 
             if not globals.config.no_assemble:
-                assembler.assemble()
+                if self.incremental_assembler and self.incremental_assembler.rolling:
+                    # the parts were muxed while downloading, only the last one is left
+                    parts = self.incremental_assembler.finish()
+                    logger.info("Saved {:d} of {:d} part(s) of the livestream.".format(
+                        len(parts), len(self.incremental_assembler.parts)))
+                    logger.separator()
+                    if len(parts) < len(self.incremental_assembler.parts) or self.incremental_assembler.late:
+                        # the segments of the parts that could not be saved are still there
+                        assembler.assemble()
+                else:
+                    if self.incremental_assembler:
+                        self.incremental_assembler.finish()
+                    assembler.assemble()
                 if globals.config.clear_temp_files:
                     helpers.remove_temp_folder()
             else:
@@ -0,0 +1,67 @@
+"""
+File to file copies that stay inside the kernel.
+
+copy_file_range and sendfile move the data without passing it through user
+space. Where neither is available or the pair of files does not support
+them (other file systems, old kernels), the data is copied with plain reads
+and writes instead.
+"""
+import errno
+import os
+
+
+CHUNK_SIZE = 1024 * 1024
+
+# errors of kernel copies that are not supported between the two files, the next method is tried
+UNSUPPORTED = set(getattr(errno, name) for name in
+                  ('EXDEV', 'ENOSYS', 'EINVAL', 'EBADF', 'EOPNOTSUPP', 'ENOTSUP', 'ETXTBSY')
+                  if hasattr(errno, name))
+
+
+def _copy_file_range(in_fd, out_fd, offset, count):
+    return os.copy_file_range(in_fd, out_fd, count, offset)
+
+
+def _sendfile(in_fd, out_fd, offset, count):
+    return os.sendfile(out_fd, in_fd, offset, count)
+
+
+METHODS = [method for method, name in ((_copy_file_range, 'copy_file_range'), (_sendfile, 'sendfile'))
+           if hasattr(os, name)]
+
+
+def copy_range(readfile, outfile, offset, count):
+    """
+    Copies count bytes from offset in readfile to the current position of
+    outfile. outfile has to be unbuffered and must not be opened in append
+    mode, copy_file_range refuses those.
+
+    :return: the number of bytes copied, less than count if readfile ended before
+    """
+    in_fd, out_fd = readfile.fileno(), outfile.fileno()
+    copied = 0
+    for method in METHODS:
+        try:
+            while copied < count:
+                n = method(in_fd, out_fd, offset + copied, count - copied)
+                if not n:
+                    break
+                copied += n
+            return copied
+        except OSError as e:
+            if e.errno not in UNSUPPORTED:
+                raise
+    readfile.seek(offset + copied)
+    while copied < count:
+        data = readfile.read(min(CHUNK_SIZE, count - copied))
+        if not data:
+            break
+        outfile.write(data)
+        copied += len(data)
+    return copied
+
+
+def append_file(outfile, path):
+    """Appends the file at path to outfile, see copy_range()"""
+    with open(path, 'rb', buffering=0) as readfile:
+        return copy_range(readfile, outfile, 0, os.fstat(readfile.fileno()).st_size)
@@ -124,6 +124,9 @@ def write_data_json():
     if not globals.download.download_stop:
         try:
             globals.download.livestream_object['segments'] = globals.download.downloader_object.segment_meta
+            globals.download.livestream_object['gaps'] = globals.download.downloader_object.gap_report()
+            globals.download.livestream_object['representation_switches'] = globals.download.downloader_object.representation_switches
+            globals.download.livestream_object['segment_status'] = dict(globals.download.downloader_object.segment_status)
             if globals.comments:
                 globals.download.livestream_object['comments'] = globals.comments.comments
             try:
@@ -271,7 +274,7 @@ def show_info():
     logger.info("PyInstaLive version:        {:s}".format(Constants.SCRIPT_VERSION))
     logger.info("Python version:             {:s}".format(Constants.PYTHON_VERSION))
     if not command_exists("ffmpeg"):
-        logger.error("FFmpeg framework:           Not found")
+        logger.warn("FFmpeg framework:           Not found (optional)")
     else:
         logger.info("FFmpeg framework:           Available")
 
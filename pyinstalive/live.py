@@ -3,19 +3,34 @@
 # This software is released under the MIT License.
 # https://opensource.org/licenses/MIT
 
+import base64
+import json
 import logging
 import os
 import time
 import re
-import hashlib
-import xml.etree.ElementTree
+import zlib
+import heapq
+import itertools
+import random
 import threading
 import shutil
 import subprocess
+import queue
+import collections
+import concurrent.futures
 
 from . import globals
+from . import dash
+from . import manifest
+from . import metrics
+from . import mp4
+from . import ratelimit
+from . import selection
+from . import transport
 
 import requests
+import urllib3
 import urllib.parse as compat_urlparse
 
 
@@ -24,7 +39,299 @@ import urllib.parse as compat_urlparse
 logger = logging.getLogger(__file__)
 
 
-MPD_NAMESPACE = {'mpd': 'urn:mpeg:dash:schema:mpd:2011'}
+MPD_NAMESPACE = dash.MPD_NAMESPACE
+
+
+class WorkerPool(object):
+    """
+    Bounded pool of download threads fed from a job queue.
+
+    The number of jobs that may run at the same time is tuned AIMD-style:
+    it grows by one slot per window of fast, successful jobs and is halved
+    when a job fails or takes longer than the target latency.
+    """
+    EWMA_WEIGHT = 0.2
+    MAX_ERROR_RATE = 0.1
+
+    def __init__(self, max_workers, min_workers=1, target_latency=5.0, name='segment'):
+        """
+        :param max_workers: hard upper bound of worker threads
+        :param min_workers: concurrency never drops below this
+        :param target_latency: job duration in seconds above which the
+            pool considers the host/CDN congested
+        :param name: prefix for the worker thread names
+        :return:
+        """
+        self.max_workers = max(1, int(max_workers))
+        self.min_workers = max(1, min(int(min_workers), self.max_workers))
+        self.target_latency = target_latency
+        self.name = name
+        self.limit = float(self.min_workers)
+        self.latency = None
+        self.error_rate = 0.0
+        self.active = 0
+        self.queue = queue.Queue()
+        self.workers = []
+        self.is_closed = False
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def submit(self, func, **kwargs):
+        """Queue a job. Returns False if the pool has been shut down."""
+        if self.is_closed:
+            return False
+        self.queue.put((func, kwargs))
+        if len(self.workers) < self.max_workers:
+            t = threading.Thread(
+                target=self._work, name='{0!s}-{1:d}'.format(self.name, len(self.workers)))
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+        return True
+
+    def shutdown(self, wait=True):
+        """Stop accepting jobs and let the workers drain the queue."""
+        if not self.is_closed:
+            self.is_closed = True
+            for _ in self.workers:
+                self.queue.put(None)
+        if wait:
+            [t.join() for t in self.workers if t.is_alive()]
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            func, kwargs = job
+            with self._cond:
+                while self.active >= int(self.limit):
+                    self._cond.wait()
+                self.active += 1
+            started = time.time()
+            try:
+                result = func(**kwargs)
+            except Exception as e:      # pylint: disable=broad-except
+                logger.warning('Unhandled error in {0!s} worker: {1!s}'.format(self.name, e))
+                result = False
+            with self._cond:
+                self.active -= 1
+                # jobs returning None do not say anything about the link
+                if result is not None:
+                    self._adjust(bool(result), time.time() - started)
+                self._cond.notify_all()
+
+    def _adjust(self, success, latency):
+        w = self.EWMA_WEIGHT
+        self.latency = latency if self.latency is None else (1 - w) * self.latency + w * latency
+        self.error_rate = (1 - w) * self.error_rate + w * (0.0 if success else 1.0)
+
+        if not success or latency > self.target_latency:
+            # only back off once per congestion event
+            now = time.time()
+            if now - self._last_decrease >= self.target_latency:
+                self._last_decrease = now
+                self.limit = max(float(self.min_workers), self.limit / 2)
+                logger.debug('Worker limit decreased to {0:d} (latency {1:.2f}s, error rate {2:.2f})'.format(
+                    int(self.limit), self.latency, self.error_rate))
+        elif self.error_rate < self.MAX_ERROR_RATE and self.limit < self.max_workers:
+            before = int(self.limit)
+            self.limit = min(float(self.max_workers), self.limit + 1.0 / self.limit)
+            if int(self.limit) > before:
+                logger.debug('Worker limit increased to {0:d} (latency {1:.2f}s)'.format(
+                    int(self.limit), self.latency))
+
+
+class PollScheduler(object):
+    """
+    Predicts when the next segment gets published and schedules the next mpd
+    poll just after that.
+
+    Every poll bounds the offset between the wall clock and the media timeline:
+    a new live edge was published at the time of the poll at the latest, and the
+    next segment had not been published yet. Polls are placed in the middle of
+    the remaining uncertainty until it is small, after which they land just
+    after the predicted publish time. Polls that find nothing new back off
+    exponentially.
+    """
+    MIN_WAIT = 0.2
+    MARGIN = 0.1
+    TOLERANCE = 0.1
+    BACKOFF_FACTOR = 2
+    HISTORY = 10
+
+    def __init__(self):
+        # live edge (end time, duration) in seconds of media time by representation
+        self.edges = {}
+        # recent upper and lower bounds of the wall clock minus media time offset
+        self.upper_bounds = {}
+        self.lower_bounds = {}
+        self.observed = {}
+        self.backoff = None
+
+    def observe(self, key, t, d, timescale):
+        """Records the live edge entry of a representation"""
+        end = float(t + d) / timescale
+        if self.edges.get(key, (None,))[0] != end:
+            self.observed[key] = (end, float(d) / timescale)
+
+    def forget(self, key):
+        """Stops tracking a representation that is no longer downloaded"""
+        for state in (self.edges, self.upper_bounds, self.lower_bounds, self.observed):
+            state.pop(key, None)
+
+    def next_wait(self, polled_at, max_wait):
+        """
+        :param polled_at: time the mpd that was just processed was requested
+        :param max_wait: upper bound for the wait, usually the minimumUpdatePeriod
+        :return: seconds to wait before the next poll
+        """
+        for key, (end, duration) in self.edges.items():
+            if key not in self.observed:
+                # the expected segment was not there yet
+                self.lower_bounds[key].append(polled_at - end - duration)
+        for key, (end, duration) in self.observed.items():
+            self.edges[key] = (end, duration)
+            self.upper_bounds.setdefault(key, collections.deque(maxlen=self.HISTORY)).append(polled_at - end)
+            self.lower_bounds.setdefault(key, collections.deque(maxlen=self.HISTORY)).append(
+                polled_at - end - duration)
+        if not self.edges:
+            return max_wait
+
+        next_publish = None
+        for key, (end, duration) in self.edges.items():
+            upper, lower = min(self.upper_bounds[key]), max(self.lower_bounds[key])
+            offset = (upper + lower) / 2 if upper - lower > self.TOLERANCE else upper
+            if next_publish is None or offset + end + duration < next_publish:
+                next_publish = offset + end + duration
+        wait = next_publish + self.MARGIN - time.time()
+
+        if self.observed:
+            self.backoff = None
+        elif wait < self.MIN_WAIT:
+            # nothing new although the segment should have been published by now
+            self.backoff = self.MIN_WAIT if self.backoff is None else self.backoff * self.BACKOFF_FACTOR
+            wait = self.backoff
+        self.observed = {}
+        max_wait = max(max_wait, max(duration for _, duration in self.edges.values()))
+        return min(max(wait, self.MIN_WAIT), max_wait)
+
+
+class RetryQueue(object):
+    """
+    Holds failed downloads until their backoff delay has passed. With a
+    dispatch function a thread hands due jobs to it, otherwise they are
+    collected with pop_due().
+    """
+
+    def __init__(self, dispatch=None, name='retry'):
+        self.dispatch = dispatch
+        self.name = name
+        self.heap = []
+        self.thread = None
+        self.is_closed = False
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, delay, job):
+        with self._cond:
+            heapq.heappush(self.heap, (time.time() + delay, next(self._counter), job))
+            if self.dispatch and self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=self.name)
+                self.thread.daemon = True
+                self.thread.start()
+            self._cond.notify()
+
+    def pop_due(self):
+        """Removes and returns the jobs whose delay has passed"""
+        jobs = []
+        with self._cond:
+            while self.heap and self.heap[0][0] <= time.time():
+                jobs.append(heapq.heappop(self.heap)[2])
+        return jobs
+
+    def close(self):
+        """Stops dispatching and returns the jobs that were still waiting"""
+        with self._cond:
+            self.is_closed = True
+            jobs = [job for _, _, job in sorted(self.heap)]
+            self.heap = []
+            self._cond.notify()
+        return jobs
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self.is_closed and (not self.heap or self.heap[0][0] > time.time()):
+                    self._cond.wait(self.heap[0][0] - time.time() if self.heap else None)
+                if self.is_closed:
+                    return
+                job = heapq.heappop(self.heap)[2]
+            self.dispatch(job)
+
+
+class SegmentWriter(object):
+    """
+    Writes a segment to a temporary file next to its final name and renames
+    it into place once complete, so that the assembler never picks up a
+    truncated segment.
+    """
+    TEMP_SUFFIX = '.part'
+    FSYNC_POLICIES = ('never', 'always')
+
+    def __init__(self, output, fsync_policy='never', validator=None):
+        self.output = output
+        self.temp_output = output + self.TEMP_SUFFIX
+        self.fsync_policy = fsync_policy
+        # checks the data as it is written, see mp4.FragmentValidator
+        self.validator = validator
+        self.size = 0
+        self.f = open(self.temp_output, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            try:
+                self.commit()
+            except Exception:
+                self.abort()
+                raise
+        else:
+            self.abort()
+
+    def write(self, data):
+        self.f.write(data)
+        self.size += len(data)
+        if self.validator:
+            self.validator.feed(data)
+
+    def commit(self):
+        if self.validator:
+            self.validator.close()
+        self.f.flush()
+        if self.fsync_policy == 'always':
+            os.fsync(self.f.fileno())
+        self.f.close()
+        os.replace(self.temp_output, self.output)
+        if self.fsync_policy == 'always' and hasattr(os, 'O_DIRECTORY'):
+            # persist the rename as well
+            fd = os.open(os.path.dirname(self.output) or '.', os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def abort(self):
+        self.f.close()
+        try:
+            os.remove(self.temp_output)
+        except OSError:
+            pass
 
 
 class Downloader(object):
@@ -33,6 +340,17 @@ class Downloader(object):
     DUPLICATE_ETAG_RETRY = 30
     MAX_CONNECTION_ERROR_RETRY = 10
     SLEEP_INTERVAL_BEFORE_RETRY = 5
+    MAX_DOWNLOAD_WORKERS = 8
+    CHUNK_SIZE = 64 * 1024
+    PREFETCH_TIMEOUT = 2
+    # exponential backoff of segment retries, kept up until the segment leaves the dvr window
+    RETRY_BACKOFF = 0.5
+    RETRY_BACKOFF_MAX = 8
+    RETRY_WINDOW = 60
+    PREFETCH_WORKERS = 4
+    CHECKPOINT_FILE = 'checkpoint.json'
+    CHECKPOINT_VERSION = 1
+    CHECKPOINT_INTERVAL = 5
 
     def __init__(self, mpd, output_dir, callback_check=None, singlethreaded=False, **kwargs):
         """
@@ -43,6 +361,22 @@ class Downloader(object):
             is over
         :param singlethreaded: flag to force single threaded downloads.
             Not advisable since this increases the probability of lost segments.
+        :param max_download_workers: upper bound of concurrent segment downloads, at least 1
+        :param fsync_policy: 'always' to fsync every completed segment, 'never' to leave it to the OS
+        :param prefetch: request the predicted next segment of each representation before
+            it shows up in the mpd. Ignored when singlethreaded.
+        :param max_resolution: largest short side in pixels to download, 0 for no cap
+        :param max_bitrate: largest representation bandwidth in bits/s to download, 0 for no cap
+        :param host_bandwidth_budget: bits/s that all downloads from the mpd host may select together
+        :param adaptive_quality: lower the quality while segments download too slowly. Off by default,
+            a switch puts a second init segment in the middle of the tracks, which needs FFmpeg to assemble
+        :param http_transport: 'requests' (default) or 'http2', see transport.TRANSPORTS
+        :param bandwidth_limit: bytes/s this download may use, 0 for no limit
+        :param global_bandwidth_limit: bytes/s all downloads sharing bandwidth_state_path may use together
+        :param bandwidth_state_path: file holding the global bandwidth bucket
+        :param resume: continue from the checkpoint a previous run left in output_dir
+        :param segment_listener: object whose segment_requested(name) and segment_done(name)
+            are called when a segment is queued and when it completed or was given up on
         :return:
         """
         self.mpd = mpd
@@ -50,9 +384,12 @@ class Downloader(object):
         if not os.path.exists(self.output_dir):
             os.makedirs(self.output_dir)
 
-        self.threads = []
-        self.downloaders = {}
+        self.requested_segments = set()
         self.last_etag = ''
+        # validators sent back to the server for conditional mpd requests
+        self.mpd_etag = ''
+        self.mpd_last_modified = ''
+        self.mpd_update_period = 1
         self.duplicate_etag_count = 0
         self.callback = callback_check
         self.is_aborted = False
@@ -66,96 +403,393 @@ class Downloader(object):
                                            or self.MAX_CONNECTION_ERROR_RETRY)
         self.sleep_interval_before_retry = (kwargs.pop('sleep_interval_before_retry', None)
                                             or self.SLEEP_INTERVAL_BEFORE_RETRY)
+        self.max_download_workers = kwargs.pop('max_download_workers', None)
+        if self.max_download_workers is None:
+            self.max_download_workers = self.MAX_DOWNLOAD_WORKERS
+        elif self.max_download_workers < 1:
+            raise ValueError('max_download_workers must be at least 1, not {0!s}'.format(self.max_download_workers))
+        self.fsync_policy = kwargs.pop('fsync_policy', None) or 'never'
+        self.prefetch = bool(kwargs.pop('prefetch', False)) and not self.singlethreaded
+        self.policy = selection.RepresentationPolicy(
+            max_resolution=kwargs.pop('max_resolution', None),
+            max_bitrate=kwargs.pop('max_bitrate', None),
+            host_budget=kwargs.pop('host_bandwidth_budget', None),
+            adaptive=kwargs.pop('adaptive_quality', False))
+        # mpd and init fetches are never delayed by the limiter, segment bytes make up for them
+        self.segment_listener = kwargs.pop('segment_listener', None)
+        self.limiter = ratelimit.BandwidthLimiter(
+            rate=kwargs.pop('bandwidth_limit', None),
+            global_rate=kwargs.pop('global_bandwidth_limit', None),
+            state_path=kwargs.pop('bandwidth_state_path', None))
+        # per thread read buffer for streaming segments to disk
+        self._buffers = threading.local()
 
-        session = globals.session.session
-
-        adapter = requests.adapters.HTTPAdapter(max_retries=2, pool_maxsize=25)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
+        # mpds and segments get their own session, so they neither carry the api
+        # cookies and browser headers nor share a session with the heartbeat thread.
+        # One connection per worker plus the mpd and init requests.
+        session = transport.media_session(
+            globals.session.session if globals.session else None,
+            pool_maxsize=self.max_download_workers + 2)
         self.session = session
+        self.transport = transport.create(
+            kwargs.pop('http_transport', None) or 'requests', session,
+            max_connections=self.max_download_workers + 2)
+
+        self.pool = None
+        self.init_pool = None
+        if not self.singlethreaded:
+            self.pool = WorkerPool(
+                self.max_download_workers,
+                min_workers=min(2, self.max_download_workers),
+                target_latency=self.download_timeout / 2.0)
+            # init segments get their own threads so that segment workers
+            # waiting for one can never starve it
+            self.init_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        self.prefetch_pool = None
+        if self.prefetch:
+            # prefetches mostly wait for the segment to be published, keep them off the segment workers
+            self.prefetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.PREFETCH_WORKERS)
+
+        # init chunks (or futures resolving to them) by (representation id, url)
+        self.init_segments = {}
+        # last processed $Time$ by representation id
+        self.timeline_positions = {}
+        # (end $Time$, duration) of the last processed entry by representation id
+        self.timeline_ends = {}
+        # timeline holes and the segment names requested to fill them
+        self.gaps = []
+        # download status by segment name: downloading, retrying, ok or failed
+        self.segment_status = {}
+        # seconds a segment stays available, from the timeShiftBufferDepth
+        self.dvr_window = None
+        self.retry_queue = RetryQueue(
+            dispatch=None if self.singlethreaded else lambda job: self.pool.submit(self._download, **job))
+        # identifiers of running prefetches, True once the mpd has listed the segment
+        self.prefetching = {}
+        self._prefetch_lock = threading.Lock()
+        # selected representation id by adaptation set
+        self.selected_representations = {}
+        # representation ids, policy changes and the index selected by adaptation set, reused while they hold
+        self.representation_cache = {}
+        # representations switched to that still need their init segment prepended
+        self.switched_representations = set()
+        self.representation_switches = []
+        # (adaptation set, representation id, duration in seconds) of downloading segments
+        self.segment_sources = {}
+        # media time in seconds at which each requested segment ends, for the live edge lag
+        # and for how long a failed segment stays in the dvr window
+        self.segment_ends = {}
+        # (representation id, $Time$) of requested segments, for the segment manifest
+        self.segment_positions = {}
+        self.segment_manifest = manifest.ManifestWriter(self.output_dir, fsync=self.fsync_policy == 'always')
+        self.live_edge = 0.0
+        # when the live edge was last seen in an mpd
+        self.live_edge_at = None
+        self.downloaded_edge = 0.0
+        self.scheduler = PollScheduler()
 
         # to store the duration of the initial buffered sgements available
         self.initial_buffered_duration = 0.0
 
+        # state is saved to the checkpoint every CHECKPOINT_INTERVAL seconds so a crashed run can be resumed
+        self.checkpoint_path = os.path.join(self.output_dir, self.CHECKPOINT_FILE)
+        self.last_checkpoint = 0.0
+        # segment files a previous run completed, and the representations it started
+        self.resumed_segments = set()
+        self.resumed_representations = set()
+        if kwargs.pop('resume', False):
+            self._load_checkpoint()
+            self._reconcile_manifest()
+
     def _store_segment_meta(self, segment, representation):
         if segment not in self.segment_meta:
             self.segment_meta[segment] = representation
 
+    def gap_report(self):
+        """
+        Lists the timeline gaps found during the download with the
+        backfilled segments that could not be recovered.
+        """
+        report = []
+        for gap in self.gaps:
+            report.append({
+                'representation': gap['representation'],
+                'start': gap['start'],
+                'end': gap['end'],
+                'duration': float(gap['end'] - gap['start']) / gap['timescale'],
+                'requested': len(gap['segments']),
+                'missing': [segment for segment in gap['segments']
+                            if self.segment_status.get(segment) == 'failed'],
+            })
+        return report
+
+    def _save_checkpoint(self):
+        """Writes the state needed to resume the download to the checkpoint file"""
+        init_segments = []
+        for (representation_id, url), init_chunk in list(self.init_segments.items()):
+            if not isinstance(init_chunk, bytes):
+                # only init segments that finished downloading
+                if not init_chunk.done() or init_chunk.cancelled() or init_chunk.exception():
+                    continue
+                init_chunk = init_chunk.result()
+            if init_chunk:
+                init_segments.append([representation_id, url, base64.b64encode(init_chunk).decode('ascii')])
+        state = {
+            'version': self.CHECKPOINT_VERSION,
+            'mpd': self.mpd,
+            'stream_id': self.stream_id,
+            'last_etag': self.last_etag,
+            'mpd_etag': self.mpd_etag,
+            'mpd_last_modified': self.mpd_last_modified,
+            'timeline_ends': self.timeline_ends,
+            'selected_representations': [list(key) + [representation_id] for key, representation_id
+                                         in self.selected_representations.items()],
+            'segment_status': dict(self.segment_status),
+            'segment_meta': dict(self.segment_meta),
+            'gaps': self.gaps,
+            'representation_switches': self.representation_switches,
+            'init_segments': init_segments,
+            'initial_buffered_duration': self.initial_buffered_duration,
+            'time': int(time.time()),
+        }
+        try:
+            with SegmentWriter(self.checkpoint_path, self.fsync_policy) as writer:
+                writer.write(json.dumps(state).encode('utf-8'))
+        except (IOError, OSError) as e:
+            logger.warning('Could not write checkpoint {0!s}: {1!s}'.format(self.checkpoint_path, e))
+        self.last_checkpoint = time.time()
+
+    def _load_checkpoint(self):
+        """
+        Restores the state a previous run saved in output_dir. Segments it
+        completed are skipped, the ones it did not finish are requested
+        again if the mpd still lists them and reported as failed otherwise.
+        """
+        try:
+            with open(self.checkpoint_path) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            logger.warning('Could not load checkpoint {0!s}: {1!s}'.format(self.checkpoint_path, e))
+            return False
+        if state.get('version') != self.CHECKPOINT_VERSION:
+            logger.warning('Ignoring checkpoint {0!s} of version {1!s}'.format(
+                self.checkpoint_path, state.get('version')))
+            return False
+
+        self.stream_id = state.get('stream_id') or self.stream_id
+        self.last_etag = state.get('last_etag') or ''
+        self.mpd_etag = state.get('mpd_etag') or ''
+        self.mpd_last_modified = state.get('mpd_last_modified') or ''
+        # timeline_positions is left empty, so the first mpd is processed in full and
+        # anything missed in between is detected as a gap from the timeline ends
+        self.timeline_ends = dict((k, tuple(v)) for k, v in state.get('timeline_ends', {}).items())
+        self.selected_representations = dict(
+            (tuple(entry[:-1]), entry[-1]) for entry in state.get('selected_representations', []))
+        self.segment_meta.update(state.get('segment_meta', {}))
+        self.gaps = state.get('gaps', [])
+        self.representation_switches = state.get('representation_switches', [])
+        self.initial_buffered_duration = state.get('initial_buffered_duration') or 0.0
+        for representation_id, url, init_chunk in state.get('init_segments', []):
+            self.init_segments[(representation_id, url)] = base64.b64decode(init_chunk)
+
+        for name in os.listdir(self.output_dir):
+            if name.endswith(SegmentWriter.TEMP_SUFFIX):
+                # left behind by a download the crash interrupted
+                os.remove(os.path.join(self.output_dir, name))
+            elif name not in (self.CHECKPOINT_FILE, manifest.FILE_NAME) and name.endswith(('.m4v', '.m4a')):
+                self.resumed_segments.add(name)
+                self.segment_status[name] = 'ok'
+        on_disk = len(self.resumed_segments)
+        recorded = dict((segment.name, segment) for segment in manifest.read(self.output_dir) or [])
+        # segments already saved into a part of the recording were deleted, they are not downloaded again
+        for name in recorded:
+            if name not in self.resumed_segments:
+                self.resumed_segments.add(name)
+                self.segment_status[name] = 'ok'
+        # the checkpoint misses what finished after it was saved and the mpd may no longer list it,
+        # the assembler only takes the segments named in segment_meta
+        for name in self.resumed_segments:
+            if name.endswith('.m4v'):
+                self._store_segment_meta(name, recorded[name].representation if name in recorded else '')
+        for name in state.get('segment_status', {}):
+            if name not in self.resumed_segments:
+                self.segment_status[name] = 'failed'
+        if self.resumed_segments:
+            # the first segments already carry the init segment
+            self.resumed_representations = set(self.selected_representations.values())
+        logger.info('Resuming download from checkpoint with {0:d} segment(s) on disk'.format(on_disk))
+        return True
+
+    def _reconcile_manifest(self):
+        """Records the resumed segments whose record a crash lost, so the manifest covers the folder"""
+        recorded = set(segment.name for segment in manifest.read(self.output_dir) or [])
+        for name in sorted(self.resumed_segments - recorded, key=self._get_file_index):
+            self._append_manifest(name, os.path.getsize(os.path.join(self.output_dir, name)),
+                                  ('', self._get_file_index(name)))
+
+    def _append_manifest(self, segment_name, size, position):
+        if not self.segment_manifest:
+            return
+        representation_id, t = position
+        try:
+            self.segment_manifest.append(segment_name, representation_id, t, size)
+        except (ValueError, IOError, OSError) as e:
+            # an incomplete manifest would hide segments, without one the folder is listed
+            logger.warning('Could not write the segment manifest, removing it: {0!s}'.format(e))
+            self.segment_manifest.discard()
+            self.segment_manifest = None
+
+    def _resumed(self, identifier, output):
+        """Returns True for a segment a previous run already downloaded"""
+        if os.path.basename(output) not in self.resumed_segments:
+            return False
+        self.segment_positions.pop(os.path.basename(output), None)
+        logger.debug('Already downloaded {0!s}'.format(identifier))
+        self.requested_segments.add(identifier)
+        if self.segment_listener:
+            self.segment_listener.segment_requested(os.path.basename(output))
+            self.segment_listener.segment_done(os.path.basename(output))
+        return True
+
     def run(self):
         """Begin downloading"""
         connection_retries_count = 0
-        while not self.is_aborted:
-            try:
-                mpd, wait = self._download_mpd()
-                connection_retries_count = 0    # reset count
+        try:
+            while not self.is_aborted:
+                try:
+                    polled_at = time.time()
+                    mpd, after = self._download_mpd()
+                    connection_retries_count = 0    # reset count
 
-                if not self.duplicate_etag_count:
-                    self._process_mpd(mpd)
-                else:
-                    logger.debug('Skip mpd processing: {0:d} - {1!s}'.format(
-                        self.duplicate_etag_count, self.last_etag))
-                if wait:
-                    logger.debug('Sleeping for {0:d}s'.format(wait))
-                    time.sleep(wait)
-
-            except requests.HTTPError as e:
-                err_msg = 'HTTPError downloading {0!s}: {1!s}.'.format(self.mpd, e)
-                if e.response is not None and \
-                        (e.response.status_code >= 500 or e.response.status_code == 404):
-                    # 505 - temporal server problem
-                    # 404 - seems to indicate that stream is starting but not ready
-                    # 403 - stream is too long gone
-                    connection_retries_count += 1
-                    if connection_retries_count <= self.max_connection_error_retry:
-                        logger.warning(err_msg)
-                        time.sleep(self.sleep_interval_before_retry)
+                    if not self.duplicate_etag_count:
+                        self._process_mpd(mpd)
                     else:
-                        logger.error(err_msg)
-                        self.is_aborted = True
-                else:
-                    logger.error(err_msg)
-                    self.is_aborted = True
-            except requests.ConnectionError as e:
-                # transient error maybe?
-                connection_retries_count += 1
-                if connection_retries_count <= self.max_connection_error_retry:
-                    logger.warning('ConnectionError downloading {0!s}: {1!s}. Retrying...'.format(self.mpd, e))
-                else:
-                    logger.error('ConnectionError downloading {0!s}: {1!s}.'.format(self.mpd, e))
-                    self.is_aborted = True
+                        logger.debug('Skip mpd processing: {0:d} - {1!s}'.format(
+                            self.duplicate_etag_count, self.last_etag))
+                    if self.singlethreaded:
+                        for job in self.retry_queue.pop_due():
+                            self._download(**job)
+                    wait = self.scheduler.next_wait(polled_at, after)
+                    if wait and not self.is_aborted:
+                        logger.debug('Sleeping for {0:.2f}s'.format(wait))
+                        time.sleep(wait)
+
+                except requests.HTTPError as e:
+                    connection_retries_count, wait = self._handle_mpd_http_error(
+                        e, e.response.status_code if e.response is not None else None,
+                        connection_retries_count)
+                    if wait:
+                        time.sleep(wait)
+                except requests.ConnectionError as e:
+                    connection_retries_count = self._handle_mpd_connection_error(e, connection_retries_count)
+        finally:
+            # stop() may come from another thread, the download is closed off on this one
+            self.is_aborted = True
+            self._finish()
+
+    def _handle_mpd_http_error(self, e, status_code, connection_retries_count):
+        """Logs a failed mpd request and returns the updated retry count and the time to wait before retrying"""
+        err_msg = 'HTTPError downloading {0!s}: {1!s}.'.format(self.mpd, e)
+        if status_code is not None and (status_code >= 500 or status_code == 404):
+            # 505 - temporal server problem
+            # 404 - seems to indicate that stream is starting but not ready
+            # 403 - stream is too long gone
+            connection_retries_count += 1
+            if connection_retries_count <= self.max_connection_error_retry:
+                logger.warning(err_msg)
+                return connection_retries_count, self.sleep_interval_before_retry
+            logger.error(err_msg)
+        else:
+            logger.error(err_msg)
+        self.is_aborted = True
+        return connection_retries_count, 0
 
-        self.stop()
+    def _handle_mpd_connection_error(self, e, connection_retries_count):
+        # transient error maybe?
+        connection_retries_count += 1
+        if connection_retries_count <= self.max_connection_error_retry:
+            logger.warning('ConnectionError downloading {0!s}: {1!s}. Retrying...'.format(self.mpd, e))
+        else:
+            logger.error('ConnectionError downloading {0!s}: {1!s}.'.format(self.mpd, e))
+            self.is_aborted = True
+        return connection_retries_count
 
     def stop(self):
         """
-        This is usually called automatically by the downloader but if the download process is
-        interrupted unexpectedly, e.g. KeyboardInterrupt, you should call this method to gracefully
-        close off the download.
+        Flags the download as aborted, from any thread. run() then retries the
+        failed segments one last time, waits for the running downloads, saves
+        the checkpoint and releases what the download holds before returning.
 
         :return:
         """
         self.is_aborted = True
-        if not self.singlethreaded:
+
+    def _finish(self):
+        """Retries the failed segments one last time, waits for the running downloads and closes off the download"""
+        if self.prefetch_pool:
+            # running prefetches of listed segments fall back to a regular download
+            self.prefetch_pool.shutdown()
+        retries = self.retry_queue.close()
+        if retries:
+            logger.debug('Retrying {0:d} segment(s) one last time...'.format(len(retries)))
+        for job in retries:
+            if self.pool:
+                self.pool.submit(self._download, **job)
+            else:
+                self._download(**job)
+        if self.pool:
             logger.debug('Stopping download threads...')
-            threads = self.downloaders.values()
-            logger.debug('{0:d} of {1:d} threads are alive'.format(
-                len([t for t in threads if t and t.is_alive()]),
-                len(threads)))
-            [t.join() for t in threads if t and t.is_alive()]
+            logger.debug('{0:d} of {1:d} workers are busy, {2:d} segment(s) queued'.format(
+                self.pool.active, len(self.pool.workers), self.pool.queue.qsize()))
+            self.pool.shutdown()
+        if self.init_pool:
+            self.init_pool.shutdown(wait=False)
+        self._close()
+
+    def _close(self):
+        """Saves the state to resume from and releases what the download holds outside of it"""
+        self.policy.release()
+        self._save_checkpoint()
+        if self.segment_manifest:
+            self.segment_manifest.close()
+        for host, stats in self.connection_stats().items():
+            logger.debug('{0!s}: {1:d} request(s) over {2:d} connection(s)'.format(
+                host, stats['requests'], stats['connections']))
+        self.transport.close()
+        self.limiter.close()
+
+    def connection_stats(self):
+        """Requests and connections opened by host for the mpd and segment downloads"""
+        return transport.connection_stats(self.session)
 
     def _download_mpd(self):
-        """Downloads the mpd stream info and returns the xml object."""
+        """Downloads the mpd stream info and returns the manifest, or None if it did not change."""
         logger.debug('Requesting {0!s}'.format(self.mpd))
-        res = self.session.get(self.mpd, headers={
-            'Accept': '*/*',
-        }, timeout=self.mpd_download_timeout)
+        started = time.time()
+        res = self.transport.get(self.mpd, headers=self._mpd_headers(), timeout=self.mpd_download_timeout)
+        metrics.mpd_poll_seconds.observe(time.time() - started)
         res.raise_for_status()
+        return self._handle_mpd(res.headers, res.content, not_modified=res.status_code == 304)
 
+    def _mpd_headers(self):
+        headers = {'Accept': '*/*'}
+        if self.mpd_etag:
+            headers['If-None-Match'] = self.mpd_etag
+        if self.mpd_last_modified:
+            headers['If-Modified-Since'] = self.mpd_last_modified
+        return headers
+
+    def _handle_mpd(self, headers, content, not_modified=False):
+        """
+        Checks the mpd response for the end of the stream and returns the parsed dash.Manifest.
+        The body is only parsed when the mpd changed, otherwise None is returned.
+        """
+        self.limiter.reserve(len(content), priority=True)
         # IG used to send this header when the broadcast ended.
         # Leaving it in in case it returns.
-        broadcast_ended = res.headers.get('X-FB-Video-Broadcast-Ended', '')
+        broadcast_ended = headers.get('X-FB-Video-Broadcast-Ended', '')
         # Use the cache-control header as indicator that stream has ended
-        cache_control = res.headers.get('Cache-Control', '')
+        cache_control = headers.get('Cache-Control', '')
         mobj = re.match(r'max\-age=(?P<age>[0-9]+)', cache_control)
         if mobj:
             max_age = int(mobj.group('age'))
@@ -163,13 +797,20 @@ class Downloader(object):
             max_age = 0
 
         # Use ETag to detect if the same mpd is received repeatedly
-        # if missing, use contents hash as psuedo etag
-        etag = res.headers.get('ETag') or hashlib.md5(res.content).hexdigest()
+        # if missing, use a cheap contents checksum as psuedo etag
+        if not_modified:
+            etag = self.last_etag
+        elif headers.get('ETag'):
+            etag = self.mpd_etag = headers.get('ETag')
+        else:
+            etag = '{0:08x}-{1:x}'.format(zlib.crc32(content) & 0xffffffff, len(content))
+        self.mpd_last_modified = headers.get('Last-Modified') or self.mpd_last_modified
         if etag != self.last_etag:
             self.last_etag = etag
             self.duplicate_etag_count = 0
         else:
             self.duplicate_etag_count += 1
+            metrics.duplicate_etags.inc()
 
         if broadcast_ended:
             logger.debug('Found X-FB-Video-Broadcast-Ended header: {0!s}'.format(broadcast_ended))
@@ -184,71 +825,81 @@ class Downloader(object):
                 logger.warning('Duplicate etag {0!s} detected {1:d} time(s)'.format(
                     etag, self.duplicate_etag_count))
                 if self.callback:
-                    callback = self.callback
-                    try:
-                        abort = callback()
-                        if abort:
-                            logger.debug('Callback returned True')
-                            self.is_aborted = True
-                    except Exception as e:      # pylint: disable=broad-except
-                        logger.warning('Error from callback: {0!s}'.format(str(e)))
+                    self._check_callback()
             # Final hard abort
             elif self.duplicate_etag_count >= self.duplicate_etag_retry:
                 logger.info('Stream likely ended (duplicate etag/hash detected).')
                 self.is_aborted = True
 
-        xml.etree.ElementTree.register_namespace('', MPD_NAMESPACE['mpd'])
-        mpd = xml.etree.ElementTree.fromstring(res.text)
-        minimum_update_period = mpd.attrib.get('minimumUpdatePeriod', '')
-        mobj = re.match('PT(?P<secs>[0-9]+)S', minimum_update_period)
-        if mobj:
-            after = int(mobj.group('secs'))
-        else:
-            after = 1
-        return mpd, after
+        if self.duplicate_etag_count:
+            return None, self.mpd_update_period
+
+        mpd = dash.parse(content)
+        self.mpd_update_period = mpd.minimum_update_period
+        return mpd, self.mpd_update_period
+
+    def _check_callback(self):
+        try:
+            abort = self.callback()
+            if abort:
+                logger.debug('Callback returned True')
+                self.is_aborted = True
+        except Exception as e:      # pylint: disable=broad-except
+            logger.warning('Error from callback: {0!s}'.format(str(e)))
+
+    def _fetch_init(self, init_segment_url, representation_id):
+        """
+        Returns the init chunk that is prepended to the first segment of a timeline.
+        Each init segment is only requested once per stream. Unless single threaded,
+        a future is returned so the mpd loop does not wait for the download.
+        """
+        key = (representation_id, init_segment_url)
+        init_chunk = self.init_segments.get(key)
+        if init_chunk is not None:
+            return init_chunk
+
+        if not self.init_pool:
+            init_chunk = self._download(init_segment_url, None, timeout=self.mpd_download_timeout)
+            if init_chunk:
+                self.init_segments[key] = init_chunk
+            return init_chunk
+
+        def forget_failed(future):
+            if future.cancelled() or future.exception() or not future.result():
+                self.init_segments.pop(key, None)
+
+        init_chunk = self.init_pool.submit(
+            self._download, init_segment_url, None, timeout=self.mpd_download_timeout)
+        self.init_segments[key] = init_chunk
+        init_chunk.add_done_callback(forget_failed)
+        return init_chunk
 
     def _process_mpd(self, mpd):
-        periods = mpd.findall('mpd:Period', MPD_NAMESPACE)
-        logger.debug('Found {0:d} period(s)'.format(len(periods)))
+        self.dvr_window = mpd.time_shift_buffer_depth
+        logger.debug('Found {0:d} period(s)'.format(len(mpd.periods)))
         # Aaccording to specs, multiple periods are allow but IG only sends one usually
-        for period in periods:
-            logger.debug('Processing period {0!s}'.format(period.attrib.get('id')))
-            for adaptation_set in period.findall('mpd:AdaptationSet', MPD_NAMESPACE):
-                representations = adaptation_set.findall('mpd:Representation', MPD_NAMESPACE)
-                # sort representations by quality and pick best one
-                representations = sorted(
-                    representations,
-                    key=lambda rep: (
-                        (int(rep.attrib.get('width', '0')) * int(rep.attrib.get('height', '0'))) or
-                        int(rep.attrib.get('bandwidth', '0')) or
-                        rep.attrib.get('FBQualityLabel') or
-                        int(rep.attrib.get('audioSamplingRate', '0'))),
-                    reverse=True)
-                representation = representations[0]
-                representation_id = representation.attrib.get('id', '')
-                logger.debug(
-                    'Selected representation with id {0!s} out of {1!s}'.format(
-                        representation_id,
-                        ' / '.join([r.attrib.get('id', '') for r in representations])
-                    ))
+        for period in mpd.periods:
+            logger.debug('Processing period {0!s}'.format(period.id))
+            for n, adaptation_set in enumerate(period.adaptation_sets):
+                key = (period.id, adaptation_set.id if adaptation_set.id is not None else n)
+                representation = self._select_representation(key, adaptation_set.representations)
 
+                representation_id = representation.id
                 representation_label = ''
                 # only store segments meta for video
-                if 'video' in representation.attrib.get('mimeType', ''):
-                    if representation.attrib.get('FBQualityLabel'):
-                        representation_label = representation.attrib.get('FBQualityLabel')
-                    elif representation.attrib.get('width') and representation.attrib.get('height'):
+                if 'video' in representation.mime_type:
+                    if representation.quality_label:
+                        representation_label = representation.quality_label
+                    elif representation.width and representation.height:
                         representation_label = '{0!s}x{1!s}'.format(
-                            representation.attrib.get('width'),
-                            representation.attrib.get('height'))
+                            representation.width, representation.height)
                     elif representation_id:
                         representation_label = representation_id
 
-                segment_template = representation.find('mpd:SegmentTemplate', MPD_NAMESPACE)
-
-                init_segment = segment_template.attrib.get('initialization')
-                media_name = segment_template.attrib.get('media')
-                timescale = int(segment_template.attrib.get('timescale'))
+                segment_template = representation.template
+                init_segment = segment_template.initialization
+                media_name = segment_template.media
+                timescale = segment_template.timescale
 
                 # store stream ID
                 if not self.stream_id:
@@ -257,79 +908,350 @@ class Downloader(object):
                         self.stream_id = mobj.group('id')
 
                 # download timeline segments
-                segment_timeline = segment_template.find('mpd:SegmentTimeline', MPD_NAMESPACE)
-                segments = segment_timeline.findall('mpd:S', MPD_NAMESPACE)
+                segments = segment_template.segments
+
+                if not self.initial_buffered_duration:
+                    buffered_duration = sum(d for _, d in segments)
+                    self.initial_buffered_duration = float(buffered_duration) / timescale
+                    logger.debug('Initial buffered duration: {0!s}'.format(self.initial_buffered_duration))
+
+                new_segments = self._new_segments(representation_id, segments)
+                if not new_segments:
+                    continue
+                logger.debug('{0:d} new segment(s) out of {1:d} for {2!s}'.format(
+                    len(new_segments), len(segments), representation_id))
 
-                buffered_duration = 0
-                for i, seg in enumerate(segments):
-                    buffered_duration += int(seg.attrib.get('d'))
-                    seg_filename = media_name.replace(
-                        '$Time$', seg.attrib.get('t')).replace('$RepresentationID$', representation_id)
-                    segment_url = compat_urlparse.urljoin(self.mpd, seg_filename)
+                previous_end, previous_duration = self.timeline_ends.get(representation_id, (None, None))
+                for i, (t, d) in enumerate(new_segments, len(segments) - len(new_segments)):
+                    if previous_end is not None and t > previous_end:
+                        # entries between the last one seen and this one left the window unseen
+                        self._backfill(
+                            representation_id, representation_label, media_name, timescale,
+                            previous_end, t, previous_duration)
+                    previous_end, previous_duration = t + d, d
+
+                    seg_filename, segment_url, segment_name = self._segment_target(
+                        media_name, representation_id, t)
 
                     if representation_label:
-                        self._store_segment_meta(
-                            os.path.basename(compat_urlparse.urlparse(seg_filename).path), representation_label)
+                        self._store_segment_meta(segment_name, representation_label)
+                    if os.path.basename(seg_filename) not in self.requested_segments:
+                        self.segment_sources[segment_name] = (key, representation_id, float(d) / timescale)
+                        self.segment_ends[segment_name] = float(t + d) / timescale
+                        self.segment_positions[segment_name] = (representation_id, t)
 
                     # Append init chunk to first segment in the timeline for now
                     # Not sure if it's needed for every segment yet
                     init_chunk = None
-                    if i == 0:
+                    if ((i == 0 and representation_id not in self.resumed_representations)
+                            or representation_id in self.switched_representations):
+                        self.switched_representations.discard(representation_id)
                         # download init segment
                         init_segment_url = compat_urlparse.urljoin(self.mpd, init_segment)
-                        init_chunk = self._download(
-                            init_segment_url, None, timeout=self.mpd_download_timeout)
+                        init_chunk = self._fetch_init(init_segment_url, representation_id)
 
                     self._extract(
                         os.path.basename(seg_filename),
                         segment_url,
-                        os.path.join(
-                            self.output_dir,
-                            os.path.basename(
-                                compat_urlparse.urlparse(seg_filename).path)
-                        ),
+                        os.path.join(self.output_dir, segment_name),
                         init_chunk=init_chunk)
 
-                if not self.initial_buffered_duration:
-                    self.initial_buffered_duration = float(buffered_duration) / timescale
-                    logger.debug('Initial buffered duration: {0!s}'.format(self.initial_buffered_duration))
+                t, d = new_segments[-1]
+                self.timeline_positions[representation_id] = t
+                self.timeline_ends[representation_id] = (previous_end, previous_duration)
+                self.scheduler.observe(representation_id, t, d, timescale)
+                self.live_edge = max(self.live_edge, float(t + d) / timescale)
+                self.live_edge_at = time.time()
+
+                if self.prefetch:
+                    self._prefetch_next(representation_id, media_name, t + d, timescale, float(d) / timescale)
+        self._update_lag()
+        if time.time() - self.last_checkpoint >= self.CHECKPOINT_INTERVAL:
+            self._save_checkpoint()
+
+    def _segment_target(self, media_name, representation_id, t):
+        """Returns the file name in the template, url and local name of the segment at $Time$ t"""
+        seg_filename = media_name.replace(
+            '$Time$', str(t)).replace('$RepresentationID$', representation_id)
+        segment_url = compat_urlparse.urljoin(self.mpd, seg_filename)
+        segment_name = os.path.basename(compat_urlparse.urlparse(seg_filename).path)
+        return seg_filename, segment_url, segment_name
+
+    def _backfill(self, representation_id, representation_label, media_name, timescale, start, end, duration):
+        """
+        Requests the segments missing from the timeline between start and
+        end. Their $Time$ is unknown, so it is stepped from start by the
+        duration of the entry before the gap. Guesses that do not exist end
+        up as failed in segment_status and are reported as missing.
+        """
+        gap = {
+            'representation': representation_id,
+            'start': start,
+            'end': end,
+            'timescale': timescale,
+            'segments': [],
+        }
+        self.gaps.append(gap)
+        logger.warning('Timeline gap of {0:.2f}s in {1!s} at {2:d}, requesting the missed segment(s)'.format(
+            float(end - start) / timescale, representation_id, start))
+        if not duration:
+            return
+        for t in range(start, end, duration):
+            seg_filename, segment_url, segment_name = self._segment_target(media_name, representation_id, t)
+            if representation_label:
+                self._store_segment_meta(segment_name, representation_label)
+            gap['segments'].append(segment_name)
+            self.segment_ends[segment_name] = float(t + duration) / timescale
+            self.segment_positions[segment_name] = (representation_id, t)
+            self._extract(
+                os.path.basename(seg_filename),
+                segment_url,
+                os.path.join(self.output_dir, segment_name))
+
+    def _prefetch_next(self, representation_id, media_name, t, timescale, duration):
+        """
+        Starts a speculative request for the segment at $Time$ t, which
+        should be published about one segment duration after the live edge.
+        """
+        seg_filename, segment_url, segment_name = self._segment_target(media_name, representation_id, t)
+        identifier = os.path.basename(seg_filename)
+        with self._prefetch_lock:
+            if identifier in self.requested_segments or segment_name in self.resumed_segments:
+                return
+            self.requested_segments.add(identifier)
+            self.prefetching[identifier] = False
+            self.segment_ends[segment_name] = float(t) / timescale + duration
+            self.segment_positions[segment_name] = (representation_id, t)
+        metrics.segments_requested.inc()
+        if self.segment_listener:
+            self.segment_listener.segment_requested(segment_name)
+        logger.debug('Prefetching {0!s}'.format(segment_url))
+        # give up after twice the segment duration, the mpd poll picks it up from there
+        deadline = time.time() + max(2 * duration, self.PREFETCH_TIMEOUT)
+        interval = min(0.5, duration / 4)
+        self._submit_prefetch(
+            identifier, segment_url, os.path.join(self.output_dir, segment_name), deadline, interval)
+
+    def _submit_prefetch(self, identifier, target, output, deadline, interval):
+        self.prefetch_pool.submit(self._prefetch_segment, identifier, target, output, deadline, interval)
+
+    def _prefetch_segment(self, identifier, target, output, deadline, interval):
+        while not self.is_aborted and time.time() < deadline:
+            try:
+                with self.transport.get(target, headers={
+                    'Accept': '*/*',
+                }, timeout=self.PREFETCH_TIMEOUT, stream=True) as res:
+                    if res.status_code != 404:
+                        res.raise_for_status()
+                        with SegmentWriter(output, self.fsync_policy, validator=mp4.FragmentValidator()) as writer:
+                            self._stream_to(res, writer)
+                            self._check_length(res.headers, writer.size)
+                        logger.debug('Prefetched {0!s}'.format(target))
+                        self._record_download(output, None, writer.size)
+                        self.segment_status[os.path.basename(output)] = 'ok'
+                        self._end_prefetch(identifier, True)
+                        return
+            except (requests.HTTPError, requests.ConnectionError, requests.Timeout,
+                    urllib3.exceptions.HTTPError, mp4.InvalidFragment) as e:
+                logger.debug('Prefetch of {0!s} failed: {1!s}'.format(target, e))
+            except (IOError, OSError) as e:
+                # left to the regular download, which reports it
+                logger.debug('Could not write prefetch of {0!s}: {1!s}'.format(target, e))
+                break
+            # not published yet
+            time.sleep(interval)
+
+        if self._end_prefetch(identifier, False):
+            # the mpd already listed it and left it to us, download it the regular way
+            self._download(target, output)
+
+    def _end_prefetch(self, identifier, success):
+        """
+        Clears a prefetch. A failed prefetch releases the segment for the
+        regular download path. Returns True if the mpd already listed it,
+        in which case the caller has to download it.
+        """
+        with self._prefetch_lock:
+            listed = self.prefetching.pop(identifier, False)
+            if not success and not listed:
+                self.requested_segments.discard(identifier)
+        return listed and not success
+
+    def _select_representation(self, key, representations):
+        """
+        Picks the representation of an adaptation set to download through the
+        policy. A switch continues the new representation from the live edge
+        of the previous one. The choice is cached until the representations
+        of the adaptation set change or the policy switches.
+        """
+        representation_ids = tuple(r.id for r in representations)
+        changes = self.policy.changes()
+        cached = self.representation_cache.get(key)
+        if cached and cached[:2] == (representation_ids, changes):
+            return representations[cached[2]]
+        representation = self.policy.select(key, representations, compat_urlparse.urlparse(self.mpd).netloc)
+        self.representation_cache[key] = (representation_ids, changes, representation_ids.index(representation.id))
+        previous_id = self.selected_representations.get(key)
+        if previous_id == representation.id:
+            return representation
+
+        self.selected_representations[key] = representation.id
+        if previous_id is None:
+            logger.debug(
+                'Selected representation with id {0!s} out of {1!s}'.format(
+                    representation.id,
+                    ' / '.join([r.id for r in self.policy.rank(representations)])
+                ))
+            return representation
+
+        reason = self.policy.pop_reason(key) or 'limit'
+        last_time = self.timeline_positions.get(previous_id)
+        logger.info('Switching representation {0!s} to {1!s} ({2!s})'.format(
+            previous_id, representation.id, reason))
+        self.representation_switches.append({
+            'from': previous_id,
+            'to': representation.id,
+            'after': last_time,
+            'reason': reason,
+            'time': int(time.time()),
+        })
+        if last_time is not None:
+            self.timeline_positions[representation.id] = last_time
+            self.timeline_ends[representation.id] = self.timeline_ends[previous_id]
+        self.switched_representations.add(representation.id)
+        self.scheduler.forget(previous_id)
+        return representation
+
+    def _record_download(self, output, elapsed, size):
+        """
+        Reports a completed segment to the metrics and its download time to
+        the representation policy. Prefetches pass no elapsed time, most of
+        it was spent waiting for the segment to be published.
+        """
+        segment_name = os.path.basename(output)
+        metrics.segments_completed.inc()
+        # recorded before the listener hears of it, readers never miss a segment it was told about
+        self._append_manifest(segment_name, size, self.segment_positions.pop(
+            segment_name, ('', self._get_file_index(segment_name))))
+        if self.segment_listener:
+            self.segment_listener.segment_done(segment_name)
+        metrics.segment_bytes.inc(size)
+        end = self.segment_ends.pop(segment_name, None)
+        if end is not None and end > self.downloaded_edge:
+            self.downloaded_edge = end
+            self._update_lag()
+        source = self.segment_sources.pop(segment_name, None)
+        if elapsed is None:
+            return
+        metrics.segment_seconds.observe(elapsed)
+        if source:
+            key, representation_id, duration = source
+            self.policy.record(key, representation_id, elapsed, duration)
+
+    def _update_lag(self):
+        if self.downloaded_edge:
+            metrics.live_edge_lag.set(max(0.0, self.live_edge - self.downloaded_edge))
+
+    def _new_segments(self, representation_id, segments):
+        """Returns the timeline entries past the last $Time$ processed for the representation"""
+        return segments.since(self.timeline_positions.get(representation_id))
 
     def _extract(self, identifier, target, output, init_chunk=None):
-        if identifier in self.downloaders:
-            logger.debug('Already downloading {0!s}'.format(identifier))
+        if self._resumed(identifier, output):
             return
+        with self._prefetch_lock:
+            if identifier in self.requested_segments:
+                if identifier in self.prefetching:
+                    self.prefetching[identifier] = True
+                logger.debug('Already downloading {0!s}'.format(identifier))
+                return
         logger.debug('Requesting {0!s}'.format(target))
         if self.singlethreaded:
             self._download(target, output, init_chunk=init_chunk)
         else:
-            # push each download into it's own thread
-            t = threading.Thread(
-                target=self._download, name=identifier,
-                kwargs={'target': target, 'output': output, 'init_chunk': init_chunk})
-            t.start()
-            self.downloaders[identifier] = t
+            # queue the download for the worker pool
+            self.pool.submit(self._download, target=target, output=output, init_chunk=init_chunk)
+        self.requested_segments.add(identifier)
+        metrics.segments_requested.inc()
+        if self.segment_listener:
+            self.segment_listener.segment_requested(os.path.basename(output))
 
-    def _download(self, target, output, timeout=None, init_chunk=None):
-        retry_attempts = self.max_connection_error_retry + 1
-        for i in range(1, retry_attempts + 1):
+    def _download(self, target, output, timeout=None, init_chunk=None, attempt=1, expires=None):
+        """
+        Downloads a segment to output, or returns the content if there is no
+        output. A segment that fails is put in the retry queue and tried
+        again with backoff until it leaves the dvr window.
+        """
+        if isinstance(init_chunk, concurrent.futures.Future):
             try:
-                res = self.session.get(target, headers={
-                    'Accept': '*/*',
-                }, timeout=timeout or self.download_timeout)
-                res.raise_for_status()
+                init_chunk = init_chunk.result()
+            except concurrent.futures.CancelledError:
+                init_chunk = None
+        if not output:
+            return self._download_content(target, timeout)
 
-                if not output:
-                    return res.content
+        segment_name = os.path.basename(output)
+        self.segment_status[segment_name] = 'downloading'
+        started = time.time()
+        metrics.active_workers.inc()
+        try:
+            with self.transport.get(target, headers={
+                'Accept': '*/*',
+            }, timeout=timeout or self.download_timeout, stream=True) as res:
+                res.raise_for_status()
 
-                with open(output, 'wb') as f:
+                with SegmentWriter(output, self.fsync_policy, validator=mp4.FragmentValidator()) as writer:
                     if init_chunk:
                         # prepend init chunk
                         logger.debug('Appended chunk len {0:d} to {1!s}'.format(
                             len(init_chunk), output))
-                        f.write(init_chunk)
-                    f.write(res.content)
-                return
-            except (requests.HTTPError, requests.ConnectionError) as e:
+                        writer.write(init_chunk)
+                    self._stream_to(res, writer)
+                    self._check_length(res.headers, writer.size - len(init_chunk or b''))
+        except (requests.HTTPError, requests.ConnectionError, requests.Timeout,
+                urllib3.exceptions.HTTPError, mp4.InvalidFragment) as e:
+            if isinstance(e, requests.HTTPError):
+                err_msg = 'HTTPError {0:d} {1!s}: {2!s}'.format(e.response.status_code, target, e)
+            elif isinstance(e, mp4.InvalidFragment):
+                err_msg = 'Invalid segment {0!s}: {1!s}'.format(target, e)
+            else:
+                err_msg = 'ConnectionError {0!s}: {1!s}'.format(target, e)
+            delay, expires = self._retry_delay(attempt, expires, segment_name)
+            if delay is None:
+                logger.error('{0!s}. Giving up.'.format(err_msg))
+                self._segment_failed(segment_name)
+                return False
+            logger.warning('{0!s}. Retrying in {1:.1f}s...'.format(err_msg, delay))
+            self.segment_status[segment_name] = 'retrying'
+            metrics.segments_retried.inc()
+            self.retry_queue.schedule(delay, dict(
+                target=target, output=output, timeout=timeout, init_chunk=init_chunk,
+                attempt=attempt + 1, expires=expires))
+            return False
+        except (IOError, OSError) as e:
+            # the segment could not be written, e.g. the disk is full
+            logger.error('Could not save {0!s}: {1!s}. Giving up.'.format(output, e))
+            self._segment_failed(segment_name)
+            return False
+        finally:
+            metrics.active_workers.dec()
+
+        self._record_download(output, time.time() - started, writer.size)
+        self.segment_status[segment_name] = 'ok'
+        return True
+
+    def _download_content(self, target, timeout=None):
+        retry_attempts = self.max_connection_error_retry + 1
+        for i in range(1, retry_attempts + 1):
+            try:
+                with self.transport.get(target, headers={
+                    'Accept': '*/*',
+                }, timeout=timeout or self.download_timeout) as res:
+                    res.raise_for_status()
+                    self.limiter.reserve(len(res.content), priority=True)
+                    return res.content
+            except (requests.HTTPError, requests.ConnectionError, requests.Timeout,
+                    urllib3.exceptions.HTTPError) as e:
                 if isinstance(e, requests.HTTPError):
                     err_msg = 'HTTPError {0:d} {1!s}: {2!s}.'.format(e.response.status_code, target, e)
                 else:
@@ -338,6 +1260,68 @@ class Downloader(object):
                     logger.warning('{0!s}. Retrying... '.format(err_msg))
                 else:
                     logger.error(err_msg)
+        return None
+
+    @staticmethod
+    def _check_length(headers, received):
+        """Raises InvalidFragment if fewer or more bytes arrived than announced"""
+        expected = headers.get('Content-Length')
+        if expected and not headers.get('Content-Encoding') and int(expected) != received:
+            raise mp4.InvalidFragment('expected {0!s} bytes, received {1:d}'.format(expected, received))
+
+    def _retry_delay(self, attempt, expires, segment_name=None):
+        """
+        Returns the backoff delay before the next attempt, or None once the
+        segment would have left the dvr window, and the time it does.
+        """
+        now = time.time()
+        window_end = self._window_end(segment_name)
+        if window_end is not None:
+            expires = window_end
+        elif expires is None:
+            # the media time of the segment is unknown, it gets a full window from its first failure
+            expires = now + (self.dvr_window or self.RETRY_WINDOW)
+        delay = min(self.RETRY_BACKOFF_MAX, self.RETRY_BACKOFF * 2 ** (attempt - 1))
+        # equal jitter keeps retries of neighbouring segments apart
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        if self.is_aborted or now + delay > expires:
+            return None, expires
+        return delay, expires
+
+    def _window_end(self, segment_name):
+        """
+        The time a segment leaves the dvr window: once the live edge is a
+        window ahead of the end of the segment. None if its end is unknown.
+        """
+        end = self.segment_ends.get(segment_name)
+        if end is None or self.live_edge_at is None:
+            return None
+        # the live edge moves on in real time between two mpd polls
+        now = time.time()
+        live_edge = self.live_edge + (now - self.live_edge_at)
+        return now + end + (self.dvr_window or self.RETRY_WINDOW) - live_edge
+
+    def _segment_failed(self, segment_name):
+        self.segment_status[segment_name] = 'failed'
+        self.segment_sources.pop(segment_name, None)
+        self.segment_ends.pop(segment_name, None)
+        self.segment_positions.pop(segment_name, None)
+        metrics.segments_lost.inc()
+        if self.segment_listener:
+            self.segment_listener.segment_done(segment_name)
+
+    def _stream_to(self, res, writer):
+        """Copies the response body to the writer through a reusable per thread buffer"""
+        buf = getattr(self._buffers, 'buf', None)
+        if buf is None:
+            buf = self._buffers.buf = memoryview(bytearray(self.CHUNK_SIZE))
+        res.raw.decode_content = True
+        while True:
+            n = res.raw.readinto(buf)
+            if not n:
+                break
+            writer.write(buf[:n])
+            self.limiter.throttle(n)
 
     @staticmethod
     def _get_file_index(filename):
@@ -0,0 +1,296 @@
+import asyncio
+import functools
+import logging
+import os
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from .live import Downloader
+from .live import SegmentWriter
+from . import metrics
+from . import mp4
+
+
+logger = logging.getLogger(__file__)
+
+
+class AsyncDownloader(Downloader):
+    """
+    Downloads a given IG live stream on a single asyncio event loop.
+
+    Speaks the same protocol as live.Downloader (mpd polling, etag tracking,
+    representation selection and the callback check) but runs all mpd polls
+    and segment fetches as coroutines using aiohttp instead of requests and
+    worker threads.
+    """
+
+    def __init__(self, mpd, output_dir, callback_check=None, singlethreaded=False, **kwargs):
+        if aiohttp is None:
+            raise ImportError('The async download engine requires the aiohttp package.')
+        super(AsyncDownloader, self).__init__(
+            mpd, output_dir, callback_check=callback_check, singlethreaded=True, **kwargs)
+        self.singlethreaded = singlethreaded
+        # prefetches are cheap coroutines here, so they do not depend on singlethreaded
+        self.prefetch = bool(kwargs.get('prefetch', False))
+        self.loop = None
+        self.client = None
+        self.semaphore = None
+        self.tasks = set()
+        self._callback_future = None
+
+    def run(self):
+        """Begin downloading"""
+        # asyncio.run() only exists from Python 3.7
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        main = self.loop.create_task(self._run())
+        try:
+            self.loop.run_until_complete(main)
+        finally:
+            # a KeyboardInterrupt leaves the download running, cancelling it closes it off
+            pending = [main] + list(self.tasks)
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            asyncio.set_event_loop(None)
+            self.loop.close()
+
+    async def _run(self):
+        self.semaphore = asyncio.Semaphore(1 if self.singlethreaded else self.max_download_workers)
+        connector = aiohttp.TCPConnector(limit=self.max_download_workers + 2)
+        try:
+            async with aiohttp.ClientSession(
+                    connector=connector, headers={'User-Agent': self.session.headers.get('User-Agent', '')}) as client:
+                self.client = client
+                connection_retries_count = 0
+                while not self.is_aborted:
+                    try:
+                        polled_at = time.time()
+                        mpd, after = await self._download_mpd_async()
+                        connection_retries_count = 0    # reset count
+
+                        if not self.duplicate_etag_count:
+                            self._process_mpd(mpd)
+                        else:
+                            logger.debug('Skip mpd processing: {0:d} - {1!s}'.format(
+                                self.duplicate_etag_count, self.last_etag))
+                        wait = self.scheduler.next_wait(polled_at, after)
+                        if wait and not self.is_aborted:
+                            logger.debug('Sleeping for {0:.2f}s'.format(wait))
+                            await asyncio.sleep(wait)
+
+                    except aiohttp.ClientResponseError as e:
+                        connection_retries_count, wait = self._handle_mpd_http_error(
+                            e, e.status, connection_retries_count)
+                        if wait:
+                            await asyncio.sleep(wait)
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        connection_retries_count = self._handle_mpd_connection_error(e, connection_retries_count)
+
+                if self.tasks:
+                    logger.debug('Waiting for {0:d} download(s) to finish...'.format(len(self.tasks)))
+                    await asyncio.gather(*self.tasks, return_exceptions=True)
+        finally:
+            # also when run() cancels the download on a KeyboardInterrupt
+            self.is_aborted = True
+            self._close()
+
+    def stop(self):
+        """
+        Flags the download as aborted. Pending segment downloads are awaited
+        by the event loop before run() returns, which then saves the
+        checkpoint and releases what the download holds.
+
+        :return:
+        """
+        self.is_aborted = True
+
+    def _proxy(self):
+        proxy = (self.session.proxies or {}).get('https')
+        if proxy and '://' not in proxy:
+            proxy = 'http://' + proxy
+        return proxy
+
+    async def _download_mpd_async(self):
+        """Downloads the mpd stream info and returns the manifest, or None if it did not change."""
+        logger.debug('Requesting {0!s}'.format(self.mpd))
+        started = time.time()
+        async with self.client.get(
+                self.mpd, headers=self._mpd_headers(), proxy=self._proxy(),
+                timeout=aiohttp.ClientTimeout(total=self.mpd_download_timeout)) as res:
+            res.raise_for_status()
+            content = await res.read()
+            metrics.mpd_poll_seconds.observe(time.time() - started)
+            return self._handle_mpd(res.headers, content, not_modified=res.status == 304)
+
+    def _check_callback(self):
+        # the callback does blocking api requests, keep it off the event loop
+        if self._callback_future is None or self._callback_future.done():
+            self._callback_future = self.loop.run_in_executor(
+                None, functools.partial(Downloader._check_callback, self))
+
+    def _fetch_init(self, init_segment_url, representation_id):
+        key = (representation_id, init_segment_url)
+        init_chunk = self.init_segments.get(key)
+        if init_chunk is not None:
+            return init_chunk
+
+        def forget_failed(task):
+            if task.cancelled() or task.exception() or not task.result():
+                self.init_segments.pop(key, None)
+
+        init_chunk = asyncio.ensure_future(
+            self._download_async(init_segment_url, None, timeout=self.mpd_download_timeout))
+        self.init_segments[key] = init_chunk
+        init_chunk.add_done_callback(forget_failed)
+        return init_chunk
+
+    def _extract(self, identifier, target, output, init_chunk=None):
+        if self._resumed(identifier, output):
+            return
+        if identifier in self.requested_segments:
+            if identifier in self.prefetching:
+                self.prefetching[identifier] = True
+            logger.debug('Already downloading {0!s}'.format(identifier))
+            return
+        logger.debug('Requesting {0!s}'.format(target))
+        task = asyncio.ensure_future(self._download_async(target, output, init_chunk=init_chunk))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        self.requested_segments.add(identifier)
+        metrics.segments_requested.inc()
+        if self.segment_listener:
+            self.segment_listener.segment_requested(os.path.basename(output))
+
+    def _submit_prefetch(self, identifier, target, output, deadline, interval):
+        task = asyncio.ensure_future(self._prefetch_segment_async(identifier, target, output, deadline, interval))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _prefetch_segment_async(self, identifier, target, output, deadline, interval):
+        while not self.is_aborted and time.time() < deadline:
+            try:
+                async with self.client.get(
+                        target, headers={'Accept': '*/*'}, proxy=self._proxy(),
+                        timeout=aiohttp.ClientTimeout(total=self.PREFETCH_TIMEOUT)) as res:
+                    if res.status != 404:
+                        res.raise_for_status()
+                        with SegmentWriter(output, self.fsync_policy, validator=mp4.FragmentValidator()) as writer:
+                            async for chunk in res.content.iter_chunked(self.CHUNK_SIZE):
+                                writer.write(chunk)
+                                await self._throttle(len(chunk))
+                            self._check_length(res.headers, writer.size)
+                        logger.debug('Prefetched {0!s}'.format(target))
+                        self._record_download(output, None, writer.size)
+                        self.segment_status[os.path.basename(output)] = 'ok'
+                        self._end_prefetch(identifier, True)
+                        return
+            except (aiohttp.ClientError, asyncio.TimeoutError, mp4.InvalidFragment) as e:
+                logger.debug('Prefetch of {0!s} failed: {1!s}'.format(target, e or type(e).__name__))
+            except (IOError, OSError) as e:
+                # left to the regular download, which reports it
+                logger.debug('Could not write prefetch of {0!s}: {1!s}'.format(target, e))
+                break
+            # not published yet
+            await asyncio.sleep(interval)
+
+        if self._end_prefetch(identifier, False):
+            # the mpd already listed it and left it to us, download it the regular way
+            await self._download_async(target, output)
+
+    async def _throttle(self, amount):
+        wait = self.limiter.reserve(amount) if self.limiter.buckets else 0
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def _download_async(self, target, output, timeout=None, init_chunk=None):
+        """
+        Downloads a segment to output, or returns the content if there is no
+        output. A failed segment is tried again with backoff until it leaves
+        the dvr window, the task sleeps in between instead of a retry queue.
+        """
+        if asyncio.isfuture(init_chunk):
+            init_chunk = await init_chunk
+        if not output:
+            return await self._download_content_async(target, timeout)
+
+        segment_name = os.path.basename(output)
+        attempt, expires = 1, None
+        while True:
+            self.segment_status[segment_name] = 'downloading'
+            started = time.time()
+            try:
+                async with self.semaphore:
+                    metrics.active_workers.inc()
+                    try:
+                        async with self.client.get(
+                                target, headers={'Accept': '*/*'}, proxy=self._proxy(),
+                                timeout=aiohttp.ClientTimeout(total=timeout or self.download_timeout)) as res:
+                            res.raise_for_status()
+
+                            with SegmentWriter(
+                                    output, self.fsync_policy, validator=mp4.FragmentValidator()) as writer:
+                                if init_chunk:
+                                    # prepend init chunk
+                                    logger.debug('Appended chunk len {0:d} to {1!s}'.format(
+                                        len(init_chunk), output))
+                                    writer.write(init_chunk)
+                                async for chunk in res.content.iter_chunked(self.CHUNK_SIZE):
+                                    writer.write(chunk)
+                                    await self._throttle(len(chunk))
+                                self._check_length(res.headers, writer.size - len(init_chunk or b''))
+                    finally:
+                        metrics.active_workers.dec()
+                self._record_download(output, time.time() - started, writer.size)
+                self.segment_status[segment_name] = 'ok'
+                return True
+            except (aiohttp.ClientError, asyncio.TimeoutError, mp4.InvalidFragment) as e:
+                if isinstance(e, aiohttp.ClientResponseError):
+                    err_msg = 'HTTPError {0:d} {1!s}: {2!s}'.format(e.status, target, e)
+                elif isinstance(e, mp4.InvalidFragment):
+                    err_msg = 'Invalid segment {0!s}: {1!s}'.format(target, e)
+                else:
+                    err_msg = 'ConnectionError {0!s}: {1!s}'.format(target, e or type(e).__name__)
+                delay, expires = self._retry_delay(attempt, expires, segment_name)
+                if delay is None:
+                    logger.error('{0!s}. Giving up.'.format(err_msg))
+                    self._segment_failed(segment_name)
+                    return False
+                logger.warning('{0!s}. Retrying in {1:.1f}s...'.format(err_msg, delay))
+                self.segment_status[segment_name] = 'retrying'
+                metrics.segments_retried.inc()
+            except (IOError, OSError) as e:
+                # the segment could not be written, e.g. the disk is full
+                logger.error('Could not save {0!s}: {1!s}. Giving up.'.format(output, e))
+                self._segment_failed(segment_name)
+                return False
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _download_content_async(self, target, timeout=None):
+        retry_attempts = self.max_connection_error_retry + 1
+        for i in range(1, retry_attempts + 1):
+            try:
+                async with self.semaphore:
+                    async with self.client.get(
+                            target, headers={'Accept': '*/*'}, proxy=self._proxy(),
+                            timeout=aiohttp.ClientTimeout(total=timeout or self.download_timeout)) as res:
+                        res.raise_for_status()
+                        content = await res.read()
+                        self.limiter.reserve(len(content), priority=True)
+                        return content
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if isinstance(e, aiohttp.ClientResponseError):
+                    err_msg = 'HTTPError {0:d} {1!s}: {2!s}.'.format(e.status, target, e)
+                else:
+                    err_msg = 'ConnectionError {0!s}: {1!s}'.format(target, e or type(e).__name__)
+                if i < retry_attempts:
+                    logger.warning('{0!s}. Retrying... '.format(err_msg))
+                else:
+                    logger.error(err_msg)
+        return None
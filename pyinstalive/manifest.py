@@ -0,0 +1,108 @@
+"""
+Append-only manifest of the segments downloaded into a segments folder.
+
+The downloader appends one fixed-size record per completed segment to
+segments.manifest: the file name, the representation, the $Time$ of the
+segment, its size and when it completed. Readers get the segments in
+completion order from a single sequential read, instead of sorting the
+names by regex and stat-ing every file. The manifest lists what was
+downloaded, not what is still on disk: segments released into a part of
+the recording keep their records, so readers check the names against a
+listing of the folder. A record torn
+by a crash is ignored and overwritten by the next run. A folder without a
+manifest (older downloads, or a name that did not fit a record) is read by
+listing it as before.
+"""
+import collections
+import os
+import struct
+import threading
+import time
+
+FILE_NAME = 'segments.manifest'
+# the last byte is the version of the record layout
+MAGIC = b'PILSEGM\x01'
+# name, representation id, $Time$, size in bytes, completion time
+RECORD = struct.Struct('<96s32sqQd')
+
+Segment = collections.namedtuple('Segment', ['name', 'representation', 'time', 'size', 'completed'])
+
+
+def path(segments_path):
+    return os.path.join(segments_path, FILE_NAME)
+
+
+def _field(value, size, what):
+    data = value.encode('utf-8')
+    if len(data) > size:
+        raise ValueError('{0!s} {1!r} does not fit a manifest record'.format(what, value))
+    return data
+
+
+class ManifestWriter(object):
+    """Appends records to the manifest of a segments folder, safe to call from several threads"""
+
+    def __init__(self, segments_path, fsync=False):
+        self.path = path(segments_path)
+        self.fsync = fsync
+        self.f = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        f = open(self.path, 'r+b' if os.path.isfile(self.path) else 'w+b', buffering=0)
+        size = os.fstat(f.fileno()).st_size
+        if size < len(MAGIC) or f.read(len(MAGIC)) != MAGIC:
+            f.seek(0)
+            f.truncate()
+            f.write(MAGIC)
+        else:
+            # drop a record the previous run did not finish writing
+            f.truncate(size - (size - len(MAGIC)) % RECORD.size)
+        f.seek(0, os.SEEK_END)
+        return f
+
+    def append(self, name, representation, t, size, completed=None):
+        """
+        :raises ValueError: if the name or representation id is too long for a record
+        """
+        record = RECORD.pack(_field(name, 96, 'Segment name'), _field(representation or '', 32, 'Representation'),
+                             t, size, completed or time.time())
+        with self._lock:
+            if self.f is None:
+                self.f = self._open()
+            self.f.write(record)
+            if self.fsync:
+                os.fsync(self.f.fileno())
+
+    def close(self):
+        with self._lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+    def discard(self):
+        """Closes and removes the manifest, readers list the folder instead"""
+        self.close()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+def read(segments_path):
+    """
+    The segments of the manifest in completion order, the latest record of
+    a segment downloaded more than once. None if the folder has no manifest.
+    """
+    try:
+        with open(path(segments_path), 'rb') as f:
+            data = f.read()
+    except (IOError, OSError):
+        return None
+    if not data.startswith(MAGIC):
+        return None
+    segments = collections.OrderedDict()
+    end = len(data) - (len(data) - len(MAGIC)) % RECORD.size
+    for name, representation, t, size, completed in RECORD.iter_unpack(data[len(MAGIC):end]):
+        name = name.rstrip(b'\0').decode('utf-8')
+        segments.pop(name, None)
+        segments[name] = Segment(name, representation.rstrip(b'\0').decode('utf-8'), t, size, completed)
+    return list(segments.values())
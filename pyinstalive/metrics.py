@@ -0,0 +1,194 @@
+"""
+Counters, gauges and histograms for the recorder internals, exposed in the
+Prometheus text format on an optional local HTTP endpoint.
+
+The metrics are module level so the downloader and the api functions can
+update them without passing a registry around. Nothing is served unless
+start_server() is called, updating a metric is a lock and an addition.
+"""
+import functools
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_metrics = []
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0!s}="{1!s}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, key, (), value) for key, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = ['# HELP {0!s} {1!s}'.format(self.name, self.documentation),
+                 '# TYPE {0!s} {1!s}'.format(self.name, self.kind)]
+        for name, key, extra, value in self._samples():
+            lines.append('{0!s}{1!s} {2!s}'.format(name, _format_labels(key, extra), _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelled=False):
+        super(Counter, self).__init__(name, documentation)
+        if not labelled:
+            # unlabelled series are exported from the start, so rates work from the first scrape
+            self.values[()] = 0
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation):
+        super(Gauge, self).__init__(name, documentation)
+        self.values[()] = 0
+
+    def set(self, value, **labels):
+        with self._lock:
+            self.values[_label_key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    samples.append((self.name + '_bucket', key, (('le', _format_value(bound)),), count))
+                samples.append((self.name + '_sum', key, (), total))
+                samples.append((self.name + '_count', key, (), counts[-1]))
+        return samples
+
+
+segments_requested = Counter('pyinstalive_segments_requested_total', 'Segments queued for download, prefetches included.')
+segments_completed = Counter('pyinstalive_segments_completed_total', 'Segments downloaded and validated.')
+segments_retried = Counter('pyinstalive_segments_retried_total', 'Segment downloads scheduled for a retry.')
+segments_lost = Counter('pyinstalive_segments_lost_total', 'Segments given up on.')
+segment_bytes = Counter('pyinstalive_segment_bytes_total', 'Bytes written to completed segments.')
+segment_seconds = Histogram('pyinstalive_segment_download_seconds', 'Duration of successful segment downloads.')
+mpd_poll_seconds = Histogram('pyinstalive_mpd_poll_seconds', 'Duration of mpd requests.')
+duplicate_etags = Counter('pyinstalive_mpd_duplicate_etags_total', 'Mpd polls that returned an unchanged mpd.')
+live_edge_lag = Gauge(
+    'pyinstalive_live_edge_lag_seconds',
+    'Media time between the newest segment in the mpd and the newest segment downloaded.')
+active_workers = Gauge('pyinstalive_active_workers', 'Segment downloads running right now.')
+api_seconds = Histogram('pyinstalive_api_request_seconds', 'Duration of Instagram api calls.')
+api_errors = Counter('pyinstalive_api_errors_total', 'Instagram api calls that raised.', labelled=True)
+
+
+def render():
+    """Returns all metrics in the Prometheus text format"""
+    return '\n'.join(metric.render() for metric in _metrics) + '\n'
+
+
+def timed(func):
+    """Records the duration of an api function in api_seconds, labelled with its name"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.time()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            api_errors.inc(endpoint=func.__name__)
+            raise
+        finally:
+            api_seconds.observe(time.time() - started, endpoint=func.__name__)
+    return wrapper
+
+
+class _MetricsServer(socketserver.ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer only exists from Python 3.7
+    daemon_threads = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_server(port, host='127.0.0.1'):
+    """
+    Serves the metrics on http://host:port/metrics from a daemon thread.
+
+    :return: the server, shut it down with server.shutdown()
+    """
+    server = _MetricsServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    return server
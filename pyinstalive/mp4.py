@@ -0,0 +1,67 @@
+"""
+Minimal ISO BMFF (MP4) box checks for downloaded live segments.
+
+Only the top level boxes are walked, a fragment is considered intact when
+its boxes add up exactly to the bytes received and it carries at least one
+moof box followed by an mdat box.
+"""
+import struct
+
+
+class InvalidFragment(ValueError):
+    """Raised for segments that are truncated or not an MP4 fragment"""
+
+
+class FragmentValidator(object):
+    """
+    Checks the top level boxes of a segment while it is being written, so the
+    data does not have to be read back. Feed it every chunk and call close()
+    once the download completed.
+    """
+
+    def __init__(self):
+        self.boxes = []
+        # bytes left of the current box, None while reading a box header
+        self._remaining = 0
+        self._header = b''
+        self._open_ended = False
+
+    def feed(self, data):
+        data = memoryview(data)
+        while len(data):
+            if self._open_ended:
+                # a box of size 0 extends to the end of the file
+                return
+            if self._remaining:
+                skipped = min(self._remaining, len(data))
+                self._remaining -= skipped
+                data = data[skipped:]
+                continue
+            needed = 16 if len(self._header) >= 8 and self._header[:4] == b'\x00\x00\x00\x01' else 8
+            taken = min(needed - len(self._header), len(data))
+            self._header += data[:taken].tobytes()
+            data = data[taken:]
+            if len(self._header) < 8:
+                continue
+            size, box_type = struct.unpack('>I4s', self._header[:8])
+            if size == 1:
+                if len(self._header) < 16:
+                    continue
+                size = struct.unpack('>Q', self._header[8:16])[0]
+            if size == 0:
+                self._open_ended = True
+            elif size < len(self._header):
+                raise InvalidFragment('invalid size {0:d} of box {1!r}'.format(size, box_type))
+            else:
+                self._remaining = size - len(self._header)
+            self.boxes.append(box_type)
+            self._header = b''
+
+    def close(self):
+        """Raises InvalidFragment unless the data fed so far is a complete fragment"""
+        if self._remaining or self._header:
+            raise InvalidFragment('truncated {0!r} box'.format(self.boxes[-1] if self.boxes else None))
+        if b'moof' not in self.boxes:
+            raise InvalidFragment('no moof box')
+        if b'mdat' not in self.boxes[self.boxes.index(b'moof'):]:
+            raise InvalidFragment('no mdat box after the moof box')
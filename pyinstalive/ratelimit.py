@@ -0,0 +1,147 @@
+"""
+Token bucket bandwidth limits for the live downloader.
+
+A recording can be limited on its own and all recordings on the machine can
+share a global budget. The global bucket lives in a small memory mapped file
+that every pyinstalive process opens and updates under an exclusive file
+lock, so concurrent `pyinstalive -d` processes started by -df draw from the
+same budget without a broker process.
+"""
+import contextlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+logger = logging.getLogger(__file__)
+
+
+class TokenBucket(object):
+    """
+    Token bucket in bytes. Callers reserve the bytes they are about to
+    transfer and wait for the returned time. Priority reservations never
+    wait but still take their bytes, so bulk transfers slow down to make up
+    for them.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: bytes per second
+        :param burst: bucket size in bytes, one second worth of rate if not given
+        :return:
+        """
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def _take(self, tokens, updated, amount, priority):
+        now = time.time()
+        tokens = min(self.burst, tokens + (now - updated) * self.rate) - amount
+        wait = 0.0 if priority or tokens >= 0 else -tokens / self.rate
+        return tokens, now, wait
+
+    def reserve(self, amount, priority=False):
+        """Takes amount bytes and returns the seconds to wait before using them"""
+        with self._lock:
+            self.tokens, self.updated, wait = self._take(self.tokens, self.updated, amount, priority)
+        return wait
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    TokenBucket whose state is kept in a memory mapped file, so processes
+    using the same file share the bucket. The processes should be configured
+    with the same rate.
+    """
+    STATE = struct.Struct('<dd')
+
+    def __init__(self, rate, path, burst=None):
+        if fcntl is None:
+            raise OSError('file locks are not supported on this platform')
+        super(SharedTokenBucket, self).__init__(rate, burst=burst)
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            with self._locked():
+                if os.fstat(self.fd).st_size < self.STATE.size:
+                    os.ftruncate(self.fd, self.STATE.size)
+                    os.pwrite(self.fd, self.STATE.pack(self.burst, time.time()), 0)
+            self.state = mmap.mmap(self.fd, self.STATE.size)
+        except Exception:
+            os.close(self.fd)
+            raise
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # flock does not exclude threads sharing the descriptor, the thread lock does
+        with self._lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def reserve(self, amount, priority=False):
+        with self._locked():
+            tokens, updated = self.STATE.unpack_from(self.state)
+            tokens, updated, wait = self._take(tokens, updated, amount, priority)
+            self.STATE.pack_into(self.state, 0, tokens, updated)
+        return wait
+
+    def close(self):
+        self.state.close()
+        os.close(self.fd)
+
+
+class BandwidthLimiter(object):
+    """Applies the per recording and the global bucket to every transfer"""
+
+    def __init__(self, rate=0, global_rate=0, state_path=None):
+        """
+        :param rate: bytes per second for this recording, 0 for no limit
+        :param global_rate: bytes per second for all recordings together, 0 for no limit
+        :param state_path: file that holds the global bucket, shared per process if not given
+        :return:
+        """
+        self.buckets = []
+        if rate:
+            self.buckets.append(TokenBucket(rate))
+        if global_rate:
+            bucket = None
+            if state_path:
+                try:
+                    bucket = SharedTokenBucket(global_rate, state_path)
+                except (OSError, ValueError) as e:
+                    logger.warning('Could not share the global bandwidth limit through {0!s}, '
+                                   'limiting this process only: {1!s}'.format(state_path, e))
+            self.buckets.append(bucket or TokenBucket(global_rate))
+
+    def reserve(self, amount, priority=False):
+        """Takes amount bytes from every bucket and returns the seconds to wait before using them"""
+        wait = 0.0
+        for bucket in self.buckets:
+            wait = max(wait, bucket.reserve(amount, priority))
+        return wait
+
+    def throttle(self, amount, priority=False):
+        """Like reserve() but sleeps for the wait itself"""
+        if self.buckets:
+            wait = self.reserve(amount, priority)
+            if wait > 0:
+                time.sleep(wait)
+
+    def close(self):
+        for bucket in self.buckets:
+            if isinstance(bucket, SharedTokenBucket):
+                bucket.close()
+        self.buckets = []
@@ -0,0 +1,331 @@
+"""
+Remuxes the video and audio track files of a livestream into one MP4 file
+without ffmpeg.
+
+The track files are fragmented MP4 as Instagram serves them: an init
+segment (ftyp and a moov with one trak) followed by moof/mdat fragments.
+The two moov boxes are merged into one, the tracks are renumbered 1 (video)
+and 2 (audio) and the fragments of both tracks are written interleaved by
+decode time, rebased so the earlier track starts at 0. The moof boxes are
+rewritten in memory, the media data after them is copied as it is, so the
+output is written in a single pass over the inputs. The result is a
+fragmented MP4 file.
+
+A track can also be read from several files one after the other, like an
+init segment kept apart from the fragments.
+
+Anything else, like a track whose init segment changes midway or fragments
+with an explicit base data offset, raises UnsupportedInput so the caller can
+fall back to ffmpeg.
+"""
+import contextlib
+import heapq
+import os
+import struct
+from fractions import Fraction
+
+from . import fastcopy
+
+VIDEO_TRACK_ID = 1
+AUDIO_TRACK_ID = 2
+
+# top level boxes that carry nothing the output needs
+_IGNORED_BOXES = (b'styp', b'sidx', b'prft', b'emsg', b'free', b'skip', b'mfra')
+
+_TFHD_BASE_DATA_OFFSET = 0x000001
+_TFHD_SAMPLE_DESCRIPTION_INDEX = 0x000002
+_TFHD_DEFAULT_SAMPLE_DURATION = 0x000008
+_TRUN_DATA_OFFSET = 0x000001
+_TRUN_FIRST_SAMPLE_FLAGS = 0x000004
+_TRUN_SAMPLE_FIELDS = ((0x000100, 'duration'), (0x000200, 'size'), (0x000400, 'flags'), (0x000800, 'offset'))
+
+
+class UnsupportedInput(ValueError):
+    """Raised for track files the remuxer cannot handle"""
+
+
+def _box(box_type, payload):
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def _children(data, start=0, end=None):
+    """Yields (type, start, header size, end) of the boxes in data[start:end]"""
+    end = len(data) if end is None else end
+    offset = start
+    while offset < end:
+        if end - offset < 8:
+            raise UnsupportedInput('truncated box header')
+        size, box_type = struct.unpack_from('>I4s', data, offset)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, offset + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            raise UnsupportedInput('invalid size of box {0!r}'.format(box_type))
+        yield box_type, offset, header, offset + size
+        offset += size
+
+
+def _child(data, box_type, start=0, end=None):
+    for child in _children(data, start, end):
+        if child[0] == box_type:
+            return child
+    raise UnsupportedInput('no {0!r} box'.format(box_type))
+
+
+def _timescale_offset(data, start):
+    """Offset of the timescale field in a mvhd or mdhd box starting its payload at start"""
+    return start + (20 if data[start] == 1 else 12)
+
+
+def _track_id_offset(data, start):
+    """Offset of the track_ID field in a tkhd box starting its payload at start"""
+    return start + (20 if data[start] == 1 else 12)
+
+
+class _Track(object):
+    """
+    The init segment and the fragments of one track, read from a file or a
+    list of files one after the other, found by reading the box headers.
+    Only the moov and moof boxes are read completely.
+    """
+
+    def __init__(self, paths):
+        self.paths = [paths] if isinstance(paths, str) else list(paths)
+        self.path = self.paths[-1]
+        self.ftyp = None
+        self.moov = None
+        self.fragments = []
+        for source, path in enumerate(self.paths):
+            with open(path, 'rb') as readfile:
+                self._scan(readfile, os.fstat(readfile.fileno()).st_size, source)
+        if self.moov is None:
+            raise UnsupportedInput('no moov box in {0!s}'.format(os.path.basename(self.path)))
+        if not self.fragments:
+            raise UnsupportedInput('no fragments in {0!s}'.format(os.path.basename(self.path)))
+
+    def _scan(self, readfile, file_size, source=0):
+        offset = 0
+        fragment = None
+        while offset < file_size:
+            readfile.seek(offset)
+            header = readfile.read(16)
+            if len(header) < 8:
+                raise UnsupportedInput('truncated box header at {0:d}'.format(offset))
+            size, box_type = struct.unpack_from('>I4s', header)
+            if size == 1:
+                if len(header) < 16:
+                    raise UnsupportedInput('truncated box header at {0:d}'.format(offset))
+                size = struct.unpack_from('>Q', header, 8)[0]
+            elif size == 0:
+                size = file_size - offset
+            if size < 8 or offset + size > file_size:
+                raise UnsupportedInput('truncated {0!r} box at {1:d}'.format(box_type, offset))
+
+            if box_type == b'moof':
+                if fragment is not None and fragment[3] is None:
+                    raise UnsupportedInput('moof box without mdat box at {0:d}'.format(fragment[1]))
+                readfile.seek(offset)
+                fragment = self._parse_moof(readfile.read(size), offset)
+                fragment.append(source)
+                self.fragments.append(fragment)
+            elif box_type == b'mdat':
+                if fragment is None:
+                    raise UnsupportedInput('mdat box before the first moof box')
+                fragment[3] = offset + size
+            elif box_type == b'moov':
+                readfile.seek(offset)
+                moov = readfile.read(size)
+                if self.moov is None:
+                    self._parse_moov(moov)
+                elif moov != self.moov:
+                    raise UnsupportedInput('the init segment changes in {0!s}'.format(os.path.basename(self.path)))
+                # the init segment is repeated after a switch, the fragment ends before it
+                fragment = None
+            elif box_type == b'ftyp':
+                if self.ftyp is None:
+                    readfile.seek(offset)
+                    self.ftyp = readfile.read(size)
+                fragment = None
+            elif box_type not in _IGNORED_BOXES:
+                raise UnsupportedInput('unexpected {0!r} box at {1:d}'.format(box_type, offset))
+            offset += size
+        if fragment is not None and fragment[3] is None:
+            raise UnsupportedInput('moof box without mdat box at {0:d}'.format(fragment[1]))
+
+    def _parse_moov(self, moov):
+        self.moov = moov
+        self.mvhd = None
+        self.trak = None
+        self.trex = None
+        self.extra = []
+        _, start, header, end = _child(moov, b'moov')
+        for box_type, child_start, child_header, child_end in _children(moov, start + header, end):
+            if box_type == b'mvhd':
+                self.mvhd = (child_start, child_header, child_end)
+            elif box_type == b'trak':
+                if self.trak is not None:
+                    raise UnsupportedInput('more than one trak box')
+                self.trak = (child_start, child_header, child_end)
+            elif box_type == b'mvex':
+                for mvex_type, mvex_start, mvex_header, mvex_end in _children(moov, child_start + child_header, child_end):
+                    if mvex_type == b'trex':
+                        self.trex = (mvex_start, mvex_header, mvex_end)
+            else:
+                self.extra.append(moov[child_start:child_end])
+        if self.mvhd is None or self.trak is None:
+            raise UnsupportedInput('incomplete moov box')
+
+        start, header, end = self.trak
+        _, tkhd_start, tkhd_header, _ = _child(moov, b'tkhd', start + header, end)
+        self.track_id = struct.unpack_from('>I', moov, _track_id_offset(moov, tkhd_start + tkhd_header))[0]
+        _, mdia_start, mdia_header, mdia_end = _child(moov, b'mdia', start + header, end)
+        _, mdhd_start, mdhd_header, _ = _child(moov, b'mdhd', mdia_start + mdia_header, mdia_end)
+        self.timescale = struct.unpack_from('>I', moov, _timescale_offset(moov, mdhd_start + mdhd_header))[0]
+        if not self.timescale:
+            raise UnsupportedInput('track timescale is 0')
+        self.default_duration = 0
+        if self.trex is not None:
+            self.default_duration = struct.unpack_from('>I', moov, self.trex[0] + self.trex[1] + 12)[0]
+
+    def _parse_moof(self, moof, offset):
+        """
+        :return: [decode time, moof offset, moof size, end of the last mdat, duration,
+                  mfhd offset, tfhd offset, tfdt offset, tfdt version], offsets into the moof.
+                  _scan() adds the index of the file the fragment is in.
+        """
+        if self.moov is None:
+            raise UnsupportedInput('moof box before the moov box')
+        _, start, header, end = next(_children(moof))
+        mfhd = None
+        traf = None
+        for box_type, child_start, child_header, child_end in _children(moof, start + header, end):
+            if box_type == b'mfhd':
+                mfhd = child_start + child_header + 4
+            elif box_type == b'traf':
+                if traf is not None:
+                    raise UnsupportedInput('more than one traf box in the moof box at {0:d}'.format(offset))
+                traf = (child_start + child_header, child_end)
+        if mfhd is None or traf is None:
+            raise UnsupportedInput('incomplete moof box at {0:d}'.format(offset))
+
+        _, tfhd_start, tfhd_header, _ = _child(moof, b'tfhd', *traf)
+        tfhd = tfhd_start + tfhd_header
+        tfhd_flags = struct.unpack_from('>I', moof, tfhd)[0] & 0xffffff
+        if struct.unpack_from('>I', moof, tfhd + 4)[0] != self.track_id:
+            raise UnsupportedInput('the moof box at {0:d} belongs to another track'.format(offset))
+        if tfhd_flags & _TFHD_BASE_DATA_OFFSET:
+            raise UnsupportedInput('explicit base data offset in the moof box at {0:d}'.format(offset))
+        default_duration = self.default_duration
+        if tfhd_flags & _TFHD_DEFAULT_SAMPLE_DURATION:
+            field = tfhd + 8 + (4 if tfhd_flags & _TFHD_SAMPLE_DESCRIPTION_INDEX else 0)
+            default_duration = struct.unpack_from('>I', moof, field)[0]
+
+        _, tfdt_start, tfdt_header, _ = _child(moof, b'tfdt', *traf)
+        tfdt = tfdt_start + tfdt_header
+        tfdt_version = moof[tfdt]
+        decode_time = struct.unpack_from('>Q' if tfdt_version == 1 else '>I', moof, tfdt + 4)[0]
+
+        duration = 0
+        for box_type, trun_start, trun_header, _ in _children(moof, *traf):
+            if box_type != b'trun':
+                continue
+            field = trun_start + trun_header
+            trun_flags, sample_count = struct.unpack_from('>II', moof, field)
+            trun_flags &= 0xffffff
+            field += 8
+            if trun_flags & _TRUN_DATA_OFFSET:
+                field += 4
+            if trun_flags & _TRUN_FIRST_SAMPLE_FLAGS:
+                field += 4
+            sample_fields = [name for flag, name in _TRUN_SAMPLE_FIELDS if trun_flags & flag]
+            if 'duration' in sample_fields:
+                stride = 4 * len(sample_fields)
+                duration += sum(struct.unpack_from('>I', moof, field + n * stride)[0] for n in range(sample_count))
+            else:
+                duration += default_duration * sample_count
+
+        return [decode_time, offset, len(moof), None, duration, mfhd - start, tfhd - start, tfdt - start, tfdt_version]
+
+    def duration(self):
+        """Seconds from the first to the end of the last fragment"""
+        first, last = self.fragments[0], self.fragments[-1]
+        return Fraction(last[0] + last[4] - first[0], self.timescale)
+
+
+def _build_moov(video, audio):
+    """One moov box with the trak boxes of both tracks, renumbered"""
+    moov = video.moov
+    mvhd = bytearray(moov[video.mvhd[0]:video.mvhd[2]])
+    # next_track_ID is the last field of mvhd
+    struct.pack_into('>I', mvhd, len(mvhd) - 4, AUDIO_TRACK_ID + 1)
+    movie_timescale = struct.unpack_from('>I', mvhd, _timescale_offset(mvhd, video.mvhd[1]))[0] or 1000
+    duration = max(video.duration(), audio.duration())
+
+    traks = []
+    trexs = []
+    for track, track_id in ((video, VIDEO_TRACK_ID), (audio, AUDIO_TRACK_ID)):
+        start, header, end = track.trak
+        trak = bytearray(track.moov[start:end])
+        _, tkhd_start, tkhd_header, _ = _child(trak, b'tkhd', header)
+        struct.pack_into('>I', trak, _track_id_offset(trak, tkhd_start + tkhd_header), track_id)
+        traks.append(bytes(trak))
+        if track.trex is not None:
+            trex = bytearray(track.moov[track.trex[0]:track.trex[2]])
+            struct.pack_into('>I', trex, track.trex[1] + 4, track_id)
+        else:
+            trex = _box(b'trex', struct.pack('>IIIIII', 0, track_id, 1, 0, 0, 0))
+        trexs.append(bytes(trex))
+
+    mehd = _box(b'mehd', struct.pack('>IQ', 1 << 24, int(duration * movie_timescale)))
+    mvex = _box(b'mvex', mehd + b''.join(trexs))
+    return _box(b'moov', bytes(mvhd) + b''.join(traks) + mvex + b''.join(video.extra))
+
+
+def remux(video_path, audio_path, output_path):
+    """
+    Writes the video and audio track files into output_path. A track can
+    be given as a list of files that are read one after the other.
+
+    :raises UnsupportedInput: if the track files are not fragmented MP4 the remuxer can handle
+    """
+    video = _Track(video_path)
+    audio = _Track(audio_path)
+    tracks = (video, audio)
+    for track in tracks:
+        decode_times = [fragment[0] for fragment in track.fragments]
+        if decode_times != sorted(decode_times):
+            raise UnsupportedInput('the decode times in {0!s} go backwards'.format(os.path.basename(track.path)))
+
+    # the earlier track starts at 0, the other one keeps its distance to it
+    start = min(Fraction(track.fragments[0][0], track.timescale) for track in tracks)
+    rebase = [int(start * track.timescale) for track in tracks]
+    order = heapq.merge(*[[(Fraction(fragment[0], track.timescale), n, index)
+                           for index, fragment in enumerate(track.fragments)]
+                          for n, track in enumerate(tracks)])
+
+    temp_path = output_path + '.part'
+    try:
+        with open(temp_path, 'wb', buffering=0) as outfile, contextlib.ExitStack() as stack:
+            readfiles = [[stack.enter_context(open(path, 'rb', buffering=0)) for path in track.paths]
+                         for track in tracks]
+            outfile.write((video.ftyp or b'') + _build_moov(video, audio))
+            for sequence_number, (_, n, index) in enumerate(order, 1):
+                track = tracks[n]
+                decode_time, offset, size, end, _, mfhd, tfhd, tfdt, tfdt_version, source = track.fragments[index]
+                readfile = readfiles[n][source]
+                readfile.seek(offset)
+                moof = bytearray(readfile.read(size))
+                struct.pack_into('>I', moof, mfhd, sequence_number)
+                struct.pack_into('>I', moof, tfhd + 4, n + 1)
+                struct.pack_into('>Q' if tfdt_version == 1 else '>I', moof, tfdt + 4, decode_time - rebase[n])
+                outfile.write(moof)
+                if fastcopy.copy_range(readfile, outfile, offset + size, end - offset - size) != end - offset - size:
+                    raise UnsupportedInput('{0!s} was truncated while remuxing'.format(os.path.basename(track.paths[source])))
+        os.replace(temp_path, output_path)
+    except BaseException:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+        raise
@@ -0,0 +1,183 @@
+import logging
+import threading
+
+
+logger = logging.getLogger(__file__)
+
+# bandwidth in bits/s of the representations selected by every policy, by host
+_host_usage = {}
+_host_lock = threading.Lock()
+# times a policy changed its share of a host budget
+_host_changes = 0
+
+
+class RepresentationPolicy(object):
+    """
+    Picks the representation to download for each adaptation set of a stream.
+
+    The highest quality representation is preferred, limited by an optional
+    resolution and bitrate cap and by a bandwidth budget that all policies
+    downloading from the same host share. When downloading a segment takes
+    close to the duration of the segment itself the link cannot keep up, so
+    the policy steps down to the next lower representation. Once the measured
+    time predicts that the higher one would fit comfortably again it steps
+    back up.
+    """
+    EWMA_WEIGHT = 0.5
+    # download time / segment duration above which the quality is lowered
+    DOWNGRADE_RATIO = 0.8
+    # predicted ratio of the higher representation below which it is restored
+    UPGRADE_RATIO = 0.4
+    # segments to measure at a representation before switching again
+    MIN_SAMPLES = 3
+
+    def __init__(self, max_resolution=0, max_bitrate=0, host_budget=0, adaptive=False):
+        """
+        :param max_resolution: largest allowed short side in pixels (720 for 720x1280), 0 for no cap
+        :param max_bitrate: largest allowed representation bandwidth in bits/s, 0 for no cap
+        :param host_budget: bandwidth in bits/s that all downloads from one host may
+            select together, 0 for no budget
+        :param adaptive: step down and up with the measured download times
+        :return:
+        """
+        self.max_resolution = max_resolution or 0
+        self.max_bitrate = max_bitrate or 0
+        self.host_budget = host_budget or 0
+        self.adaptive = adaptive
+        # number of steps below the best allowed representation by adaptation set
+        self.levels = {}
+        # candidates and the selected representation id by adaptation set
+        self.selected = {}
+        self.ratios = {}
+        self.samples = {}
+        # why the selection of an adaptation set last changed
+        self.reasons = {}
+        self.switches = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def rank(representations):
+        """Sorts representations from best to worst quality"""
+        return sorted(
+            representations,
+            key=lambda rep: (
+                (rep.width * rep.height) or
+                rep.bandwidth or
+                rep.quality_label or
+                rep.sampling_rate),
+            reverse=True)
+
+    def _allowed(self, representation):
+        if self.max_resolution and representation.width and representation.height:
+            if min(representation.width, representation.height) > self.max_resolution:
+                return False
+        if self.max_bitrate and representation.bandwidth > self.max_bitrate:
+            return False
+        return True
+
+    def _host_allowance(self, host, key):
+        """Bandwidth left in the host budget for the adaptation set"""
+        with _host_lock:
+            used = sum(bandwidth for owner, bandwidth in _host_usage.get(host, {}).items()
+                       if owner != (id(self), key))
+        return self.host_budget - used
+
+    def select(self, key, representations, host=None):
+        """
+        :param key: identifies the adaptation set
+        :param representations: the representations of the adaptation set
+        :param host: host the segments are downloaded from
+        :return: the representation to download
+        """
+        global _host_changes
+        ranked = self.rank(representations)
+        candidates = [rep for rep in ranked if self._allowed(rep)] or ranked[-1:]
+        if self.host_budget and host:
+            allowance = self._host_allowance(host, key)
+            candidates = [rep for rep in candidates if rep.bandwidth <= allowance] or candidates[-1:]
+
+        with self._lock:
+            level = min(self.levels.get(key, 0), len(candidates) - 1)
+            self.levels[key] = level
+            chosen = candidates[level]
+            previous = self.selected.get(key)
+            if previous and previous[1] != chosen.id and key not in self.reasons:
+                self.reasons[key] = 'limit'
+            self.selected[key] = (candidates, chosen.id)
+
+        if self.host_budget and host:
+            with _host_lock:
+                usage = _host_usage.setdefault(host, {})
+                if usage.get((id(self), key)) != chosen.bandwidth:
+                    usage[(id(self), key)] = chosen.bandwidth
+                    _host_changes += 1
+        return chosen
+
+    def changes(self):
+        """
+        Counts the switches and the host budget changes so far. A selection
+        stays valid for the same representations while this is unchanged.
+        """
+        return self.switches + (_host_changes if self.host_budget else 0)
+
+    def pop_reason(self, key):
+        """Returns and clears why the selection of the adaptation set changed"""
+        with self._lock:
+            return self.reasons.pop(key, None)
+
+    def record(self, key, representation_id, elapsed, duration):
+        """
+        Feeds the download time of a segment back into the policy.
+
+        :param key: identifies the adaptation set
+        :param representation_id: representation the segment belongs to
+        :param elapsed: seconds the download took
+        :param duration: media duration of the segment in seconds
+        :return:
+        """
+        if not self.adaptive or not duration:
+            return
+        with self._lock:
+            candidates, selected_id = self.selected.get(key, (None, None))
+            if representation_id != selected_id:
+                # finished after a switch
+                return
+            ratio = float(elapsed) / duration
+            previous = self.ratios.get(key)
+            ratio = ratio if previous is None else (
+                self.EWMA_WEIGHT * ratio + (1 - self.EWMA_WEIGHT) * previous)
+            self.ratios[key] = ratio
+            self.samples[key] = self.samples.get(key, 0) + 1
+            if self.samples[key] < self.MIN_SAMPLES:
+                return
+
+            level = self.levels.get(key, 0)
+            current = candidates[level]
+            if ratio > self.DOWNGRADE_RATIO and level < len(candidates) - 1:
+                self._switch(key, level + 1, 'congested', ratio)
+            elif level > 0:
+                higher = candidates[level - 1]
+                if current.bandwidth and higher.bandwidth:
+                    predicted = ratio * higher.bandwidth / current.bandwidth
+                else:
+                    predicted = ratio * 2
+                if predicted < self.UPGRADE_RATIO:
+                    self._switch(key, level - 1, 'recovered', ratio)
+
+    def _switch(self, key, level, reason, ratio):
+        logger.debug('Switching {0!s} to level {1:d} ({2!s}, download/duration ratio {3:.2f})'.format(
+            key, level, reason, ratio))
+        self.levels[key] = level
+        self.reasons[key] = reason
+        self.ratios.pop(key, None)
+        self.samples[key] = 0
+        self.switches += 1
+
+    def release(self):
+        """Gives the bandwidth selected by this policy back to the host budgets"""
+        global _host_changes
+        with _host_lock:
+            for usage in _host_usage.values():
+                for owner in [owner for owner in usage if owner[0] == id(self)]:
+                    del usage[owner]
+                    _host_changes += 1
@@ -14,6 +14,7 @@ from pyinstalive import helpers
 from . import logger
 from . import globals
 from . import api
+from . import transport
 from .constants import Constants
 
 class Session:
@@ -97,6 +98,15 @@ class Session:
         self.cookies = None
         self.expires_epoch = None
         self.proxy = None
+        self.transport = None
+
+    def get_transport(self):
+        # the session object is replaced on login, build a new transport around the current one
+        if self.transport is None or self.transport.session is not self.session:
+            if self.transport:
+                self.transport.close()
+            self.transport = transport.create(globals.config.http_transport, self.session)
+        return self.transport
 
     def authenticate(self, username=None, password=None, cookie_file=None):
         try:
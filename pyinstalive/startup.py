@@ -8,7 +8,11 @@ from . import globals
 from . import logger
 from . import helpers
 from . import assembler
+from . import batch
 from . import organize
+from . import live_async
+from . import metrics
+from . import transport
 from .constants import Constants
 from .session import Session
 from .download import Download
@@ -49,6 +53,21 @@ def validate_settings():
             globals.config.cmd_on_ended = globals.config.parser_object.get("pyinstalive", "cmd_on_ended")
             globals.config.ffmpeg_path = globals.config.parser_object.get("pyinstalive", "ffmpeg_path")
             globals.config.cookie_file = globals.config.parser_object.get("pyinstalive", "cookie_file") if globals.config.parser_object.has_option("pyinstalive", "cookie_file") else None
+            globals.config.download_workers = globals.config.parser_object.getint("pyinstalive", "download_workers") if globals.config.parser_object.has_option("pyinstalive", "download_workers") else globals.config.download_workers
+            globals.config.download_engine = globals.config.parser_object.get("pyinstalive", "download_engine") if globals.config.parser_object.has_option("pyinstalive", "download_engine") else globals.config.download_engine
+            globals.config.segment_fsync = globals.config.parser_object.get("pyinstalive", "segment_fsync") if globals.config.parser_object.has_option("pyinstalive", "segment_fsync") else globals.config.segment_fsync
+            globals.config.segment_prefetch = globals.config.parser_object.getboolean("pyinstalive", "segment_prefetch") if globals.config.parser_object.has_option("pyinstalive", "segment_prefetch") else globals.config.segment_prefetch
+            globals.config.max_resolution = globals.config.parser_object.getint("pyinstalive", "max_resolution") if globals.config.parser_object.has_option("pyinstalive", "max_resolution") else globals.config.max_resolution
+            globals.config.max_bitrate = globals.config.parser_object.getint("pyinstalive", "max_bitrate") if globals.config.parser_object.has_option("pyinstalive", "max_bitrate") else globals.config.max_bitrate
+            globals.config.host_bandwidth_budget = globals.config.parser_object.getint("pyinstalive", "host_bandwidth_budget") if globals.config.parser_object.has_option("pyinstalive", "host_bandwidth_budget") else globals.config.host_bandwidth_budget
+            globals.config.adaptive_quality = globals.config.parser_object.getboolean("pyinstalive", "adaptive_quality") if globals.config.parser_object.has_option("pyinstalive", "adaptive_quality") else globals.config.adaptive_quality
+            globals.config.http_transport = globals.config.parser_object.get("pyinstalive", "http_transport") if globals.config.parser_object.has_option("pyinstalive", "http_transport") else globals.config.http_transport
+            globals.config.bandwidth_limit = globals.config.parser_object.getint("pyinstalive", "bandwidth_limit") if globals.config.parser_object.has_option("pyinstalive", "bandwidth_limit") else globals.config.bandwidth_limit
+            globals.config.global_bandwidth_limit = globals.config.parser_object.getint("pyinstalive", "global_bandwidth_limit") if globals.config.parser_object.has_option("pyinstalive", "global_bandwidth_limit") else globals.config.global_bandwidth_limit
+            globals.config.metrics_port = globals.config.parser_object.getint("pyinstalive", "metrics_port") if globals.config.parser_object.has_option("pyinstalive", "metrics_port") else globals.config.metrics_port
+            globals.config.assemble_workers = globals.config.parser_object.getint("pyinstalive", "assemble_workers") if globals.config.parser_object.has_option("pyinstalive", "assemble_workers") else globals.config.assemble_workers
+            globals.config.split_minutes = globals.config.parser_object.getint("pyinstalive", "split_minutes") if globals.config.parser_object.has_option("pyinstalive", "split_minutes") else globals.config.split_minutes
+            globals.config.split_megabytes = globals.config.parser_object.getint("pyinstalive", "split_megabytes") if globals.config.parser_object.has_option("pyinstalive", "split_megabytes") else globals.config.split_megabytes
 
             if globals.args.download_path:
                 globals.config.download_path = globals.args.download_path
@@ -69,23 +88,74 @@ def validate_settings():
                         logger.separator()
                     else:
                         logger.separator()
-                        logger.error("Could not find the required FFmpeg framework.")
-                        validate_succeeded = False
+                        logger.warn("Could not find the FFmpeg framework, segments are only assembled "
+                                    "with the built-in remuxer.")
+                        globals.config.ffmpeg_path = None
                         logger.separator()
             else:
                 globals.config.ffmpeg_path = os.getenv('FFMPEG_BINARY', 'ffmpeg')
                 if not helpers.command_exists(globals.config.ffmpeg_path):
-                    logger.error("Could not find the required FFmpeg framework.")
-                    validate_succeeded = False
+                    logger.warn("Could not find the FFmpeg framework, segments are only assembled "
+                                "with the built-in remuxer.")
+                    globals.config.ffmpeg_path = None
                     logger.separator()
         
             if globals.args.no_assemble:
                 globals.config.no_assemble = True
 
+            if globals.args.download_engine:
+                globals.config.download_engine = globals.args.download_engine
+            if globals.config.download_engine not in ["threaded", "async"]:
+                logger.warn("Unknown download engine '{:s}', falling back to the threaded engine.".format(globals.config.download_engine))
+                logger.separator()
+                globals.config.download_engine = "threaded"
+            elif globals.config.download_engine == "async" and live_async.aiohttp is None:
+                logger.warn("The async download engine requires the 'aiohttp' package, falling back to the threaded engine.")
+                logger.separator()
+                globals.config.download_engine = "threaded"
+
+            if globals.config.http_transport not in transport.TRANSPORTS:
+                logger.warn("Unknown http transport '{:s}', falling back to 'requests'.".format(globals.config.http_transport))
+                logger.separator()
+                globals.config.http_transport = "requests"
+            elif globals.config.http_transport == "http2" and not transport.http2_available():
+                logger.warn("The http2 transport requires the 'httpx' and 'h2' packages, falling back to 'requests'.")
+                logger.separator()
+                globals.config.http_transport = "requests"
+
+            if globals.config.download_workers < 1:
+                logger.error("The number of download workers must be at least 1, not {:d}.".format(globals.config.download_workers))
+                logger.error("Change 'download_workers' in the configuration file and try again.")
+                logger.separator()
+                validate_succeeded = False
+
+            if globals.config.assemble_workers < 1:
+                logger.warn("The number of assemble workers must be at least 1, falling back to 1.")
+                logger.separator()
+                globals.config.assemble_workers = 1
+
+            if globals.config.split_minutes < 0 or globals.config.split_megabytes < 0:
+                logger.warn("The split limits can not be negative, the recording is not split into parts.")
+                logger.separator()
+                globals.config.split_minutes = 0
+                globals.config.split_megabytes = 0
+
+            if globals.config.segment_fsync not in ["never", "always"]:
+                logger.warn("Unknown segment fsync policy '{:s}', falling back to 'never'.".format(globals.config.segment_fsync))
+                logger.separator()
+                globals.config.segment_fsync = "never"
+
             if globals.args.download:
                 globals.download = Download(globals.args.download)
                 if globals.config.download_comments:
                     globals.comments = Comments()
+                if globals.config.metrics_port:
+                    try:
+                        metrics.start_server(globals.config.metrics_port)
+                        logger.binfo("Serving metrics on http://127.0.0.1:{:d}/metrics".format(globals.config.metrics_port))
+                    except OSError as e:
+                        logger.warn("Could not serve metrics on port {:d}: {:s}".format(globals.config.metrics_port, str(e)))
+                    logger.separator()
             
             if globals.args.download_following:
                 if not helpers.command_exists("pyinstalive"):
@@ -131,8 +201,9 @@ def run():
     parser.add_argument('-dp', '--download-path', dest='download_path', metavar='', type=str, required=False, help="Override the default download path.")
     parser.add_argument('-dc', '--download-comments', dest='download_comments', action="store_true", required=False, help="Download livestream comments. Overrides the configuration file setting.")
     parser.add_argument('-gc', '--generate-comments', dest='generate_comments_path', metavar='', type=str, required=False, help="Generate a comments log file. Requires a livestream JSON file.")
-    parser.add_argument('-gv', '--generate-video', dest='generate_video_path', metavar='', type=str, required=False, help="Assemble downloaded livestream segments into a video file. Requires a livestream segments folder.")
+    parser.add_argument('-gv', '--generate-video', dest='generate_video_path', metavar='', type=str, nargs='*', required=False, help="Assemble downloaded livestream segments into video files. Takes one or more livestream segments folders or glob patterns, assembles every unassembled segments folder in the download path if none are given.")
     parser.add_argument('-na', '--no-assemble', dest='no_assemble', action='store_true', help="Do not assemble the downloaded livestream segments into a video file. Overrides the configuration file setting.")
+    parser.add_argument('-de', '--download-engine', dest='download_engine', metavar='', type=str, required=False, choices=["threaded", "async"], help="Segment download engine to use: 'threaded' or 'async'. Overrides the configuration file setting.")
     parser.add_argument('-c', '--cookies', dest='cookies', metavar='', type=str, required=False, help="Path to Netscape cookie file for login.")
     parser.add_argument('-ec', '--export-cookies', dest='export_cookies', metavar='', type=str, required=False, help="Export current session cookies to a Netscape cookie file.")
 
@@ -144,7 +215,7 @@ def run():
         logger.warn('    ' + ' '.join(unknown_args))
         logger.separator(pre_config=True)
 
-    if not any(vars(globals.args).values()):
+    if all(value is None or value is False for value in vars(globals.args).values()):
         logger.error("No known arguments were provided.", pre_config=True)
         logger.separator(pre_config=True)
         validate_success = False
@@ -176,8 +247,14 @@ def run():
                 globals.session = Session(username=globals.config.username, password=globals.config.password)
                 if globals.session.authenticate():
                     globals.session.export_cookies(globals.args.export_cookies)
-            elif globals.args.generate_video_path:
-                assembler.assemble()
+            elif globals.args.generate_video_path is not None:
+                paths = batch.resolve_paths(globals.args.generate_video_path)
+                if not paths:
+                    logger.error("Could not find any livestream segments folders to assemble.")
+                elif len(paths) == 1:
+                    assembler.assemble(generate_video_path=paths[0])
+                else:
+                    batch.assemble_all(paths)
             elif globals.args.generate_comments_path:
                 Comments().generate_log()
             elif globals.args.clean:
@@ -0,0 +1,240 @@
+"""
+HTTP transports for the api requests and the live downloader.
+
+RequestsTransport is the default and sends everything through the
+requests.Session it wraps. Http2Transport sends the same requests through
+httpx with HTTP/2, which multiplexes all requests to an origin over one
+connection. Both return responses with the part of the requests interface
+PyInstaLive uses and raise requests exceptions, so callers do not have to
+know which one they got.
+"""
+import requests
+import requests.adapters
+import requests.structures
+
+from .constants import Constants
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import h2
+except ImportError:
+    h2 = None
+
+
+TRANSPORTS = ('requests', 'http2')
+
+
+def http2_available():
+    return httpx is not None and h2 is not None
+
+
+def create(name, session, **kwargs):
+    """
+    :param name: one of TRANSPORTS
+    :param session: requests.Session holding the headers, cookies and proxies to use
+    :return: the transport
+    """
+    if name == 'http2':
+        return Http2Transport(session, **kwargs)
+    return RequestsTransport(session)
+
+
+def media_session(source=None, pool_maxsize=10, pool_hosts=4):
+    """
+    Builds a session for mpd and segment requests. It shares nothing with the
+    api session: no cookies, only the user agent and proxies are copied and
+    the headers are kept to the minimum the CDN needs.
+
+    :param source: the api requests.Session to copy the user agent and proxies from
+    :param pool_maxsize: connections kept open per host
+    :param pool_hosts: number of hosts to keep connection pools for
+    :return: the requests.Session
+    """
+    session = requests.Session()
+    session.headers = requests.structures.CaseInsensitiveDict(Constants.MEDIA_HEADERS)
+    if source is not None:
+        user_agent = source.headers.get('User-Agent')
+        if user_agent:
+            session.headers['User-Agent'] = user_agent
+        session.proxies = dict(source.proxies or {})
+    adapter = requests.adapters.HTTPAdapter(max_retries=2, pool_connections=pool_hosts, pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def connection_stats(session):
+    """
+    Returns the requests sent and connections opened by the pools of a
+    requests.Session, by host. Requests minus connections is the number
+    of requests that reused a kept-alive connection.
+    """
+    stats = {}
+    for adapter in set(session.adapters.values()):
+        pools = getattr(getattr(adapter, 'poolmanager', None), 'pools', None)
+        if pools is None:
+            continue
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host_stats = stats.setdefault(pool.host, {'requests': 0, 'connections': 0})
+            host_stats['requests'] += pool.num_requests
+            host_stats['connections'] += pool.num_connections
+    return stats
+
+
+class RequestsTransport(object):
+    """Sends requests through a requests.Session over HTTP/1.1"""
+    name = 'requests'
+
+    def __init__(self, session):
+        self.session = session
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.session.post(url, **kwargs)
+
+    def close(self):
+        # the session belongs to the caller
+        pass
+
+
+def _translate_error(e):
+    """
+    Maps an httpx exception to the one requests raises in its place, so the
+    handlers written for requests treat both transports the same: a connect
+    timeout is also a ConnectionError, a read timeout is not.
+    """
+    message = str(e) or type(e).__name__
+    if isinstance(e, httpx.ConnectTimeout):
+        return requests.ConnectTimeout(message)
+    if isinstance(e, httpx.TimeoutException):
+        return requests.ReadTimeout(message)
+    if isinstance(e, httpx.ProxyError):
+        return requests.exceptions.ProxyError(message)
+    return requests.ConnectionError(message)
+
+
+class _Http2Body(object):
+    """File-like view of a streamed httpx response, standing in for requests' Response.raw"""
+
+    def __init__(self, response):
+        self.decode_content = True
+        self._chunks = response.iter_bytes()
+        self._pending = b''
+
+    def readinto(self, buf):
+        if not self._pending:
+            try:
+                self._pending = next(self._chunks, b'')
+            except httpx.HTTPError as e:
+                raise _translate_error(e)
+        n = min(len(buf), len(self._pending))
+        buf[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+
+class Http2Response(object):
+    """The part of the requests.Response interface PyInstaLive uses, backed by an httpx response"""
+
+    def __init__(self, response, stream=False):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = str(response.url)
+        self.reason = response.reason_phrase
+        self.http_version = response.http_version
+        self.raw = _Http2Body(response) if stream else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    @property
+    def content(self):
+        try:
+            return self._response.read()
+        except httpx.HTTPError as e:
+            raise _translate_error(e)
+
+    @property
+    def text(self):
+        self.content
+        return self._response.text
+
+    def json(self, **kwargs):
+        return self._response.json(**kwargs)
+
+    def raise_for_status(self):
+        if 400 <= self.status_code < 600:
+            kind = 'Client' if self.status_code < 500 else 'Server'
+            raise requests.HTTPError('{0:d} {1!s} Error: {2!s} for url: {3!s}'.format(
+                self.status_code, kind, self.reason, self.url), response=self)
+
+    def close(self):
+        self._response.close()
+
+
+class Http2Transport(object):
+    """
+    Sends requests through an httpx client with HTTP/2 enabled. Headers,
+    cookies and proxies are taken from the wrapped requests.Session on every
+    request and cookies set by responses are stored back into it, so the
+    session stays the single source of login state.
+    """
+    name = 'http2'
+
+    def __init__(self, session, max_connections=None, prior_knowledge=False):
+        """
+        :param session: requests.Session with the headers, cookies and proxies to use
+        :param max_connections: connection limit over all origins, None for httpx's default
+        :param prior_knowledge: speak HTTP/2 to plain http:// origins without
+            negotiating it first (h2c), for local servers
+        :return:
+        """
+        if not http2_available():
+            raise ImportError('The http2 transport requires the httpx and h2 packages.')
+        self.session = session
+        proxy = (session.proxies or {}).get('https')
+        if proxy and '://' not in proxy:
+            proxy = 'http://' + proxy
+        limits = httpx.Limits(max_connections=max_connections) if max_connections else httpx.Limits()
+        self.client = httpx.Client(
+            http1=not prior_knowledge, http2=True, proxy=proxy, limits=limits, follow_redirects=True)
+
+    def request(self, method, url, headers=None, timeout=None, stream=False, data=None, **kwargs):
+        merged_headers = dict(self.session.headers)
+        merged_headers.update(headers or {})
+        # let requests encode the body and pick the cookies so both transports send the same
+        prepared = requests.Request(method, url, headers=merged_headers, data=data).prepare()
+        prepared.prepare_cookies(self.session.cookies)
+        prepared.headers.pop('Content-Length', None)
+        try:
+            response = self.client.send(
+                self.client.build_request(
+                    method, url, headers=dict(prepared.headers), content=prepared.body, timeout=timeout),
+                stream=stream)
+        except httpx.HTTPError as e:
+            raise _translate_error(e)
+        for set_cookie in response.cookies.jar:
+            self.session.cookies.set_cookie(set_cookie)
+        return Http2Response(response, stream=stream)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        self.client.close()
@@ -25,6 +25,10 @@ setup(
         'requests',
         'brotli'
     ],
+    extras_require={
+        'async': ['aiohttp'],
+        'http2': ['httpx[http2]'],
+    },
     include_package_data=True,
     platforms='any',
     long_description=long_description,